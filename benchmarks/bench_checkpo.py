@@ -0,0 +1,186 @@
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+# ---------------- Dữ liệu giả ----------------
+def make_po_frame(n_lines, n_products=5000, seed=1):
+    rnd = random.Random(seed)
+    codes, qtys, receivers = [], [], []
+    for _ in range(n_lines):
+        # ~5% mã không có trong danh mục
+        codes.append(f"SP{rnd.randint(1, int(n_products * 1.05)):06d}")
+        qtys.append(float(rnd.randint(1, 120)))
+        receivers.append(f"CH{rnd.randint(1, 40)}")
+    df = pd.DataFrame({'Mã SP': codes, 'SL cần giao': qtys, 'ĐV nhận': receivers})
+
+    code_map = {}
+    stock_map = {}
+    for pid in range(1, n_products + 1):
+        code = f"SP{pid:06d}"
+        code_map[code] = {'id': pid, 'display_name': f"[{code}] Sản phẩm {pid}"}
+        stock_map[pid] = {
+            'HN_STOCK': rnd.randint(0, 80),
+            'HN_TRANSIT': rnd.randint(0, 30),
+            'HCM_STOCK': rnd.randint(0, 120),
+        }
+        if rnd.random() < 0.05:
+            # Odoo cho tồn âm khi bán vượt
+            stock_map[pid][rnd.choice(list(stock_map[pid]))] = -rnd.randint(1, 20)
+    return df, code_map, stock_map
+
+
+# ---------------- Cách tính cũ (iterrows) ----------------
+# Chỉ để so thời gian: với kho tồn âm bản cũ lấy cả số âm (SL kéo âm, thiếu ảo)
+def legacy_checkpo(payload):
+    df, code_map, stock_map = payload
+    rows = []
+    for _, r in df.iterrows():
+        code = r['Mã SP']
+        need_qty = int(round(r['SL cần giao']))
+        receiver = r['ĐV nhận']
+
+        prod = code_map.get(code)
+        if not prod:
+            rows.append((code, 'KHÔNG TÌM THẤY', receiver, need_qty,
+                         0, 0, 0, 0, 'KHÔNG TÌM THẤY MÃ', 0, need_qty))
+            continue
+
+        stock = stock_map[prod['id']]
+        hn, hcm, tr = stock['HN_STOCK'], stock['HCM_STOCK'], stock['HN_TRANSIT']
+        total_hn = hn + tr
+        pull = 0
+        shortage = 0
+
+        if need_qty <= hn:
+            status = "ĐỦ tại kho HN (201/201)"
+        elif need_qty <= total_hn:
+            status = "ĐỦ (HN + Kho nhập HN)"
+        else:
+            req = need_qty - total_hn
+            if req <= hcm:
+                pull = req
+                status = "CẦN KÉO HÀNG TỪ HCM"
+            else:
+                pull = hcm
+                shortage = req - hcm
+                status = "THIẾU DÙ ĐÃ KÉO TỐI ĐA"
+
+        rows.append((code, prod['display_name'], receiver, need_qty,
+                     hn, tr, total_hn, hcm, status, pull, shortage))
+    return rows
+
+
+# Cột của sheet KiemTraPO trước khi có phân bổ theo PO
+BASE_COLUMNS = [
+    'Mã SP', 'Tên SP', 'ĐV nhận', 'SL cần giao',
+    'Tồn HN', 'Tồn Kho Nhập', 'Tổng tồn HN', 'Tồn HCM',
+    'Trạng thái', 'SL cần kéo từ HCM', 'SL thiếu'
+]
+
+
+def vectorized_checkpo(payload, mode='independent'):
+    result = main.evaluate_po(*payload, mode=mode)
+    return list(zip(*(result[col].tolist() for col in BASE_COLUMNS)))
+
+
+# ---------------- Cách tính tuần tự (chuẩn để so kết quả) ----------------
+# Duyệt từng dòng theo thứ tự ưu tiên ĐV nhận rồi thứ tự trong PO, lấy lần lượt qua các
+# kho local rồi kho nguồn (kho âm coi như 0). allocate: trừ dần tồn còn lại của SP;
+# independent: mỗi dòng so với toàn bộ tồn
+def reference_checkpo(payload, priority=(), mode='allocate'):
+    df, code_map, stock_map = payload
+    order = main.STOCK_LOCATIONS.local + main.STOCK_LOCATIONS.sources
+    n_local = len(main.STOCK_LOCATIONS.local)
+    rank_of = {r: i for i, r in enumerate(priority)}
+
+    lines = list(df[['Mã SP', 'SL cần giao', 'ĐV nhận']].itertuples(index=False, name=None))
+    sequence = sorted(
+        range(len(lines)),
+        key=lambda i: (rank_of.get(str(lines[i][2]).strip().lower(), len(priority)), i),
+    )
+
+    remaining = {}
+    rows = [None] * len(lines)
+    for i in sequence:
+        code, qty, receiver = lines[i]
+        need = int(round(qty))
+        prod = code_map.get(code)
+        if not prod:
+            rows[i] = ((code, 'KHÔNG TÌM THẤY', receiver, need) + (0,) * (len(order) + 1)
+                       + (main.PO_STATUS_NOT_FOUND,) + (0,) * len(order) + (need,))
+            continue
+
+        levels = [stock_map[prod['id']].get(l.key, 0) for l in order]
+        usable = [max(level, 0) for level in levels]
+        left = remaining.setdefault(prod['id'], usable) if mode == 'allocate' else list(usable)
+        allocs = []
+        status = main.PO_STATUS_SHORT
+        got = 0
+        for j, loc in enumerate(order):
+            take = min(left[j], need - got)
+            left[j] -= take
+            got += take
+            allocs.append(take)
+            if got == need and status == main.PO_STATUS_SHORT:
+                status = loc.status
+        rows[i] = ((code, prod['display_name'], receiver, need)
+                   + tuple(levels[:n_local]) + (sum(levels[:n_local]),) + tuple(levels[n_local:])
+                   + (status,) + tuple(allocs) + (need - got,))
+    return rows
+
+
+def full_rows(payload, mode, priority=()):
+    result = main.evaluate_po(*payload, mode=mode, priority=list(priority))
+    return list(zip(*(result[col].tolist() for col in main.KIEMTRAPO_COLUMNS)))
+
+
+def check_allocate(n_lines, seed=7):
+    # Ít SP để nhiều dòng PO dùng chung một SP; có cả danh sách ưu tiên ĐV nhận
+    payload = make_po_frame(n_lines, n_products=max(10, n_lines // 8), seed=seed)
+    for priority in ([], ['ch7', 'ch3', 'ch22']):
+        if full_rows(payload, 'allocate', priority) != reference_checkpo(payload, priority):
+            raise SystemExit(f"Phân bổ khác cách tính tuần tự ({n_lines} dòng, ưu tiên {priority})")
+
+
+def measure(fn, payload):
+    tracemalloc.start()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    result = fn(payload)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, cpu, wall, peak
+
+
+def main_bench(sizes):
+    print(f"{'dòng PO':>8} | {'cũ CPU(s)':>10} {'cũ peak(MB)':>12} | "
+          f"{'mới CPU(s)':>10} {'mới peak(MB)':>12} | {'x nhanh':>7} | {'dòng khác bản cũ':>16}")
+    check_allocate(2000)
+    for n in sizes:
+        payload = make_po_frame(n)
+        old, old_cpu, _, old_peak = measure(legacy_checkpo, payload)
+        new, new_cpu, _, new_peak = measure(vectorized_checkpo, payload)
+        if full_rows(payload, 'independent') != reference_checkpo(payload, mode='independent'):
+            raise SystemExit(f"Kết quả khác nhau với {n} dòng PO")
+        # Chỉ khác bản cũ ở dòng của SP có kho tồn âm
+        changed = sum(1 for a, b in zip(old, new) if a != b)
+        _, alloc_cpu, _, _ = measure(lambda p: vectorized_checkpo(p, 'allocate'), payload)
+        print(f"{n:>8} | {old_cpu:>10.3f} {old_peak / 1e6:>12.1f} | "
+              f"{new_cpu:>10.3f} {new_peak / 1e6:>12.1f} | {old_cpu / max(new_cpu, 1e-9):>7.1f} | "
+              f"{changed:>16} | phân bổ {alloc_cpu:.3f}s")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 50_000, 200_000]
+    main_bench(sizes)
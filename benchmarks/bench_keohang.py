@@ -0,0 +1,153 @@
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import pandas  # noqa: F401  nạp trước để thời gian import không tính vào phép đo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# ---------------- Dữ liệu giả ----------------
+HN_ID, TRAN_ID, HCM_ID = 10, 30, 20
+HN_KEY, TRAN_KEY, HCM_KEY = 'HN_STOCK', 'HN_TRANSIT', 'HCM_STOCK'
+TREE = {HN_ID: HN_KEY, TRAN_ID: TRAN_KEY, HCM_ID: HCM_KEY}
+
+
+def make_quants(n_products, quants_per_cell=2, seed=1):
+    rnd = random.Random(seed)
+    quants = []
+    for pid in range(1, n_products + 1):
+        for loc in (HN_ID, TRAN_ID, HCM_ID):
+            if rnd.random() < 0.3:
+                continue
+            for _ in range(quants_per_cell):
+                qty = float(rnd.randint(0, 60))
+                reserved = float(rnd.randint(0, int(qty))) if rnd.random() < 0.2 else 0.0
+                roll = rnd.random()
+                if roll < 0.03:
+                    # quant âm (xuất quá tồn, lô sai)
+                    qty = -float(rnd.randint(1, 40))
+                elif roll < 0.06:
+                    # giữ chỗ nhiều hơn tồn -> CÓ HÀNG âm
+                    reserved = qty + float(rnd.randint(1, 20))
+                quants.append({
+                    'id': len(quants) + 1,
+                    'product_id': [pid, f"SP{pid}"],
+                    'location_id': [loc, f"LOC{loc}"],
+                    'quantity': qty,
+                    'reserved_quantity': reserved,
+                    'available_quantity': qty - reserved,
+                })
+    return quants
+
+
+# ---------------- Cách tính cũ (vòng lặp Python) ----------------
+# Báo cáo trước đây: bỏ từng quant <= 0 rồi mới cộng
+def legacy_keohang(quant_data):
+    stock_map = {}
+    for q in quant_data:
+        pid = q['product_id'][0]
+        loc = q['location_id'][0]
+
+        if loc == TRAN_ID:
+            real_qty = float(q.get('quantity', 0))
+        else:
+            real_qty = float(q.get('available_quantity', 0))
+
+        if real_qty <= 0:
+            continue
+
+        if pid not in stock_map:
+            stock_map[pid] = {'hn': 0, 'tran': 0, 'hcm': 0}
+
+        if loc == HN_ID:
+            stock_map[pid]['hn'] += real_qty
+        elif loc == TRAN_ID:
+            stock_map[pid]['tran'] += real_qty
+        elif loc == HCM_ID:
+            stock_map[pid]['hcm'] += real_qty
+
+    report = []
+    for pid, qtys in stock_map.items():
+        ton_hn = int(round(qtys['hn']))
+        ton_tran = int(round(qtys['tran']))
+        ton_hcm = int(round(qtys['hcm']))
+        tong_hn = ton_hn + ton_tran
+        if tong_hn < main.TARGET_MIN_QTY:
+            de_xuat = min(main.TARGET_MIN_QTY - tong_hn, ton_hcm)
+            if de_xuat > 0:
+                report.append((pid, ton_hn, ton_tran, ton_hcm, de_xuat))
+    return report
+
+
+# Cùng vòng lặp nhưng cộng theo (SP, kho) trước rồi mới chặn âm về 0: đây là số
+# kho tồn chung / read_group trả về (tổng theo kho), nên là chuẩn để so kết quả mới
+def reference_keohang(quant_data):
+    stock_map = {}
+    for q in quant_data:
+        pid = q['product_id'][0]
+        loc = q['location_id'][0]
+        if loc == TRAN_ID:
+            real_qty = float(q.get('quantity', 0))
+        else:
+            real_qty = float(q.get('available_quantity', 0))
+
+        qtys = stock_map.setdefault(pid, {HN_ID: 0.0, TRAN_ID: 0.0, HCM_ID: 0.0})
+        qtys[loc] += real_qty
+
+    report = []
+    for pid, qtys in stock_map.items():
+        ton_hn, ton_tran, ton_hcm = (int(round(max(qtys[loc], 0.0))) for loc in (HN_ID, TRAN_ID, HCM_ID))
+        tong_hn = ton_hn + ton_tran
+        if tong_hn < main.TARGET_MIN_QTY:
+            de_xuat = min(main.TARGET_MIN_QTY - tong_hn, ton_hcm)
+            if de_xuat > 0:
+                report.append((pid, ton_hn, ton_tran, ton_hcm, de_xuat))
+    return report
+
+
+def vectorized_keohang(quant_data):
+    suggest = main.compute_keohang(main.quants_to_frame(quant_data, TREE))
+    if suggest is None:
+        return []
+    return list(zip(
+        suggest.index.tolist(), suggest[HN_KEY].tolist(), suggest[TRAN_KEY].tolist(),
+        suggest[HCM_KEY].tolist(), suggest['de_xuat'].tolist(),
+    ))
+
+
+def measure(fn, payload):
+    tracemalloc.start()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    result = fn(payload)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, cpu, wall, peak
+
+
+def main_bench(sizes):
+    print(f"{'SP':>8} {'quant':>9} | {'cũ CPU(s)':>10} {'cũ peak(MB)':>12} | "
+          f"{'mới CPU(s)':>10} {'mới peak(MB)':>12} | {'x nhanh':>7} | {'SP khác bản cũ':>14}")
+    for n in sizes:
+        payload = make_quants(n)
+        old, old_cpu, _, old_peak = measure(legacy_keohang, payload)
+        new, new_cpu, _, new_peak = measure(vectorized_keohang, payload)
+        if reference_keohang(payload) != new:
+            raise SystemExit(f"Kết quả khác nhau với {n} SP")
+        # Chỉ khác bản cũ ở SP có quant âm / giữ chỗ quá tồn (cộng trước rồi mới chặn 0)
+        legacy = {row[0]: row for row in old}
+        changed = sum(1 for row in new if legacy.pop(row[0], None) != row) + len(legacy)
+        print(f"{n:>8} {len(payload):>9} | {old_cpu:>10.3f} {old_peak / 1e6:>12.1f} | "
+              f"{new_cpu:>10.3f} {new_peak / 1e6:>12.1f} | {old_cpu / max(new_cpu, 1e-9):>7.1f} | "
+              f"{changed:>14}")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 50_000, 200_000]
+    main_bench(sizes)
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fake_odoo import FAKE_DB, FAKE_PASSWORD, FAKE_USER  # noqa: E402
+from run_bench import start_fake_odoo  # noqa: E402
+
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl')
+
+# Chạy trong process con: đo import, khôi phục trạng thái, lần tra mã đầu và /keohang đầu
+CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t_import = time.perf_counter() - t0
+loaded = [m for m in {heavy!r} if m in sys.modules]
+t_restore = main.warm_start()
+t = time.perf_counter()
+main.lookup_product_stock({code!r})
+t_lookup = time.perf_counter() - t
+t = time.perf_counter()
+report = main.build_keohang_report()
+t_keohang = time.perf_counter() - t
+if not report.ok:
+    raise SystemExit(report.message)
+main.STATE.close()
+print(json.dumps({{
+    'import_s': t_import, 'restore_s': t_restore, 'first_lookup_s': t_lookup,
+    'first_keohang_s': t_keohang, 'loaded_at_import': loaded,
+}}))
+"""
+
+
+def run_child(url, lazy, state_db, code):
+    env = dict(
+        os.environ,
+        ODOO_URL=url, ODOO_DB=FAKE_DB, ODOO_USERNAME=FAKE_USER, ODOO_PASSWORD=FAKE_PASSWORD,
+        TELEGRAM_TOKEN=os.environ.get('TELEGRAM_TOKEN', '0:bench'),
+        BOT_LAZY_IMPORTS='1' if lazy else '0', STATE_DB=state_db,
+    )
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD.format(heavy=HEAVY_MODULES, code=code)],
+        env=env, cwd=os.path.dirname(HERE), capture_output=True, text=True, check=True,
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    # Tính cả khởi động interpreter: từ lúc tạo process tới khi có /keohang đầu tiên
+    result['process_s'] = time.perf_counter() - started
+    return result
+
+
+def main_bench(n_products, repeat, latency):
+    proc, url, control = start_fake_odoo(latency)
+    try:
+        control.load(n_products)
+        code = f"SP{max(1, n_products // 2):06d}"
+        with tempfile.TemporaryDirectory() as tmp:
+            warm_db = os.path.join(tmp, 'state.db')
+            run_child(url, True, warm_db, code)  # nạp sẵn trạng thái cho kịch bản warm
+
+            modes = [
+                ('eager, không state', False, ''),
+                ('lazy, không state', True, ''),
+                ('lazy, state warm', True, warm_db),
+            ]
+            keys = ['import_s', 'restore_s', 'first_lookup_s', 'first_keohang_s', 'process_s']
+            print(f"{'chế độ':<22}" + "".join(f"{k:>17}" for k in keys) + "  import sẵn")
+            results = {}
+            for name, lazy, state_db in modes:
+                runs = [run_child(url, lazy, state_db, code) for _ in range(repeat)]
+                med = {k: statistics.median(r[k] for r in runs) for k in keys}
+                med['loaded_at_import'] = runs[-1]['loaded_at_import']
+                results[name] = med
+                print(f"{name:<22}" + "".join(f"{med[k]:>16.3f}s" for k in keys)
+                      + f"  {','.join(med['loaded_at_import']) or '-'}")
+            return results
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đo thời gian khởi động bot với Odoo giả")
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help="giây trễ thêm cho mỗi RPC")
+    parser.add_argument('--json', help="ghi kết quả ra file JSON")
+    opts = parser.parse_args()
+
+    results = main_bench(opts.products, opts.repeat, opts.latency)
+    if opts.json:
+        with open(opts.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
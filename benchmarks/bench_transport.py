@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main  # noqa: E402
+from fake_odoo import FAKE_DB, FAKE_PASSWORD, FAKE_USER  # noqa: E402
+from run_bench import start_fake_odoo  # noqa: E402
+
+QUANT_FIELDS = ['product_id', 'location_id', 'quantity', 'reserved_quantity', 'available_quantity']
+
+
+# So sánh XML-RPC và JSON-RPC trên cùng 1 lệnh search_read stock.quant lớn:
+# byte nhận về, thời gian, CPU phía bot (marshal + parse) và peak bộ nhớ.
+def read_quants(client):
+    uid = client.authenticate()
+    return client.execute_kw(
+        FAKE_DB, uid, FAKE_PASSWORD,
+        'stock.quant', 'search_read', [[]], {'fields': QUANT_FIELDS}
+    )
+
+
+def measure(url, protocol, gzip_enabled, repeat):
+    client = main.OdooClient(url, FAKE_DB, FAKE_USER, FAKE_PASSWORD, pool_size=1,
+                             protocol=protocol, gzip_enabled=gzip_enabled)
+    read_quants(client)  # kết nối + đăng nhập trước
+
+    proxy = client._acquire()
+    client._release(proxy)
+
+    # Thời gian / CPU đo không bật tracemalloc (tracemalloc làm chậm parse)
+    best = None
+    for _ in range(repeat):
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        rows = read_quants(client)
+        run = (time.perf_counter() - wall, time.process_time() - cpu)
+        best = run if best is None or run[0] < best[0] else best
+
+    tracemalloc.start()
+    read_quants(client)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    wire = proxy._bot_transport.last_response_bytes
+    return best[0], best[1], peak, wire, len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="So sánh XML-RPC / JSON-RPC khi đọc stock.quant")
+    parser.add_argument('sizes', nargs='*', type=int, default=[5_000, 20_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    opts = parser.parse_args()
+
+    proc, url, control = start_fake_odoo(0.0)
+    try:
+        print(f"{'SP':>7} {'giao thức':<9} {'gzip':<5} | {'quant':>7} {'nhận (KB)':>10} "
+              f"{'thời gian':>9} {'CPU bot':>8} {'peak (MB)':>9}")
+        for n in opts.sizes:
+            control.load(n)
+            for protocol in ('xmlrpc', 'jsonrpc'):
+                for gzip_enabled in (False, True):
+                    wall, cpu, peak, wire, rows = measure(url, protocol, gzip_enabled, opts.repeat)
+                    print(f"{n:>7} {protocol:<9} {'có' if gzip_enabled else 'không':<5} | {rows:>7} "
+                          f"{wire / 1024:>10.0f} {wall:>8.2f}s {cpu:>7.2f}s {peak / 1e6:>9.1f}")
+    finally:
+        proc.terminate()
+        proc.wait()
@@ -0,0 +1,456 @@
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from socketserver import ThreadingMixIn
+from xmlrpc.server import MultiPathXMLRPCServer, SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+import xmlrpc.client
+
+# ---------------- Odoo giả (XML-RPC) cho benchmark ----------------
+# Phục vụ /xmlrpc/2/common, /xmlrpc/2/object và /jsonrpc với dữ liệu sinh ngẫu nhiên,
+# đếm số lệnh gọi theo model/method và có thể thêm độ trễ mỗi lệnh gọi.
+# /bench là endpoint điều khiển cho run_bench.py (nạp dữ liệu, đếm RPC...).
+FAKE_DB = 'bench'
+FAKE_USER = 'admin'
+FAKE_PASSWORD = 'admin'
+FAKE_UID = 2
+
+
+def _m2o(record):
+    if record is None:
+        return False
+    return [record['id'], record.get('display_name') or record.get('name') or str(record['id'])]
+
+
+class FakeDataset:
+    def __init__(self, n_products=1000, quants_per_location=1, n_moves=None, seed=1):
+        rnd = random.Random(seed)
+        self.models = defaultdict(dict)
+
+        users = self.models['res.users']
+        for uid, name in [(1, 'OdooBot'), (2, 'Administrator'), (7, 'Thủ kho HN')]:
+            users[uid] = {'id': uid, 'name': name, 'display_name': name}
+
+        locations = self.models['stock.location']
+        tree = [
+            (1, None, 'Physical Locations', 'view'),
+            (10, 1, '201/201', 'internal'),
+            (11, 10, '201/201/Kệ A', 'internal'),
+            (20, 1, '124/124', 'internal'),
+            (30, 1, 'Kho nhập Hà Nội', 'internal'),
+            (40, 1, '305/305', 'internal'),
+            (90, None, 'Partners/Customers', 'customer'),
+        ]
+        for lid, parent, name, usage in tree:
+            parent_path = (locations[parent]['parent_path'] if parent else '') + f"{lid}/"
+            locations[lid] = {
+                'id': lid, 'name': name.split('/')[-1], 'complete_name': name,
+                'display_name': name, 'location_id': parent, 'usage': usage,
+                'parent_path': parent_path, 'write_date': '2024-01-01 00:00:00',
+            }
+
+        products = self.models['product.product']
+        for i in range(1, n_products + 1):
+            code = f"SP{i:06d}"
+            products[i] = {
+                'id': i, 'default_code': code, 'name': f"Sản phẩm {i}",
+                'display_name': f"[{code}] Sản phẩm {i}", 'active': True,
+                'write_date': '2024-01-01 00:00:00',
+            }
+
+        quants = self.models['stock.quant']
+        qid = 1
+        stock_locs = [10, 11, 20, 30, 40]
+        for pid in range(1, n_products + 1):
+            for loc in stock_locs:
+                for _ in range(quants_per_location):
+                    if rnd.random() < 0.3:
+                        continue
+                    qty = float(rnd.randint(0, 120))
+                    reserved = float(rnd.randint(0, int(qty))) if qty and rnd.random() < 0.2 else 0.0
+                    quants[qid] = {
+                        'id': qid, 'product_id': pid, 'location_id': loc,
+                        'quantity': qty, 'reserved_quantity': reserved,
+                        'write_date': '2024-01-01 00:00:00',
+                    }
+                    qid += 1
+        self._next_id = {'stock.quant': qid}
+
+        pickings = self.models['stock.picking']
+        moves = self.models['stock.move']
+        move_lines = self.models['stock.move.line']
+        n_moves = n_moves if n_moves is not None else n_products * 2
+        for mid in range(1, n_moves + 1):
+            pick_id = (mid - 1) // 5 + 1
+            if pick_id not in pickings:
+                pickings[pick_id] = {
+                    'id': pick_id, 'name': f"201/IN/{pick_id:05d}",
+                    'display_name': f"201/IN/{pick_id:05d}",
+                    'create_uid': 2, 'write_uid': rnd.choice([2, 7]),
+                    'write_date': '2024-01-01 00:00:00',
+                }
+            pid = rnd.randint(1, n_products)
+            moves[mid] = {
+                'id': mid, 'product_id': pid, 'picking_id': pick_id,
+                'location_id': 90, 'location_dest_id': 10,
+                'write_date': '2024-01-01 00:00:00',
+            }
+            move_lines[mid] = dict(moves[mid], move_id=mid)
+
+        self.lock = threading.RLock()
+        self.clock = 0
+
+    # ---------- thay đổi tồn cho kịch bản watchdog ----------
+    def now(self, backdate=0):
+        self.clock += 1
+        return time.strftime('%Y-%m-%d %H:%M:%S',
+                             time.gmtime(1_710_000_000 + self.clock - backdate))
+
+    def receive(self, product_ids, location_id=10, qty=5.0, backdate=0):
+        # backdate > 0: giả lập transaction dài, commit dòng mang write_date cũ hơn hiện tại
+        with self.lock:
+            quants = self.models['stock.quant']
+            ts = self.now(backdate)
+            for pid in product_ids:
+                hit = next((q for q in quants.values()
+                            if q['product_id'] == pid and q['location_id'] == location_id), None)
+                if hit is None:
+                    qid = self._next_id['stock.quant']
+                    self._next_id['stock.quant'] += 1
+                    hit = quants[qid] = {
+                        'id': qid, 'product_id': pid, 'location_id': location_id,
+                        'quantity': 0.0, 'reserved_quantity': 0.0,
+                    }
+                hit['quantity'] += qty
+                hit['write_date'] = ts
+                mid = max(self.models['stock.move'] or [0]) + 1
+                move = {'id': mid, 'product_id': pid, 'picking_id': 1,
+                        'location_id': 90, 'location_dest_id': location_id, 'write_date': ts}
+                self.models['stock.move'][mid] = move
+                self.models['stock.move.line'][mid] = dict(move, move_id=mid)
+
+
+class FakeOdoo:
+    def __init__(self, dataset, latency=0.0):
+        self.data = dataset
+        self.latency = latency
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+
+    # ---------- đếm lệnh gọi ----------
+    def reset_counters(self):
+        with self.calls_lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        with self.calls_lock:
+            return sum(self.calls.values())
+
+    def calls_by_method(self):
+        with self.calls_lock:
+            return {f"{model}.{method}": n for (model, method), n in self.calls.items()}
+
+    def _count(self, key):
+        with self.calls_lock:
+            self.calls[key] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _check(self, db, uid, password):
+        if db != FAKE_DB or uid != FAKE_UID or password != FAKE_PASSWORD:
+            raise xmlrpc.client.Fault(3, 'odoo.exceptions.AccessDenied: Access Denied')
+
+    # ---------- common ----------
+    def authenticate(self, db, login, password, user_agent_env):
+        self._count(('common', 'authenticate'))
+        if db == FAKE_DB and login == FAKE_USER and password == FAKE_PASSWORD:
+            return FAKE_UID
+        return False
+
+    def version(self):
+        return {'server_version': '17.0-fake', 'protocol_version': 1}
+
+    # ---------- object ----------
+    def execute_kw(self, db, uid, password, model, method, args=None, kw=None):
+        self._count((model, method))
+        self._check(db, uid, password)
+        args = list(args or [])
+        kw = dict(kw or {})
+        if model not in self.data.models:
+            raise xmlrpc.client.Fault(2, f"Object {model} doesn't exist")
+        with self.data.lock:
+            handler = getattr(self, f"_m_{method}", None)
+            if handler is None:
+                raise xmlrpc.client.Fault(2, f"Method {method} not supported on {model}")
+            return handler(model, *args, **kw)
+
+    def _value(self, model, rec, field, context=None):
+        if model == 'stock.quant' and field == 'available_quantity':
+            return rec['quantity'] - rec['reserved_quantity']
+        if model == 'product.product' and field == 'qty_available':
+            loc = (context or {}).get('location')
+            total = 0.0
+            for q in self.data.models['stock.quant'].values():
+                if q['product_id'] != rec['id']:
+                    continue
+                if loc and not self._child_of(q['location_id'], [loc]):
+                    continue
+                total += q['quantity']
+            return total
+        return rec.get(field, False)
+
+    def _child_of(self, location_id, roots):
+        loc = self.data.models['stock.location'].get(location_id)
+        if not loc:
+            return False
+        parts = loc['parent_path'].strip('/').split('/')
+        return any(str(r) in parts for r in roots)
+
+    def _relation(self, model, field):
+        return {
+            'product_id': 'product.product',
+            'location_id': 'stock.location',
+            'location_dest_id': 'stock.location',
+            'picking_id': 'stock.picking',
+            'product_tmpl_id': 'product.template',
+            'move_id': 'stock.move',
+            'create_uid': 'res.users',
+            'write_uid': 'res.users',
+        }.get(field) if not (model == 'stock.location' and field == 'location_id') else 'stock.location'
+
+    def _leaf(self, model, rec, leaf):
+        field, op, value = leaf
+        if '.' in field:
+            # Một bước quan hệ many2one, vd. ('location_id.usage', 'in', [...])
+            rel_field, sub = field.split('.', 1)
+            rel = self._relation(model, rel_field)
+            target = self.data.models[rel].get(rec.get(rel_field)) if rel else None
+            return bool(target) and self._leaf(rel, target, (sub, op, value))
+        if op == 'child_of':
+            roots = value if isinstance(value, (list, tuple)) else [value]
+            if field == 'id':
+                return self._child_of(rec['id'], roots)
+            return self._child_of(rec.get(field), roots)
+        cur = rec['id'] if field == 'id' else self._value(model, rec, field)
+        if op == '=':
+            return cur == value
+        if op == '!=':
+            return cur != value
+        if op == 'in':
+            return cur in value
+        if op == 'not in':
+            return cur not in value
+        if op in ('>', '<', '>=', '<='):
+            if cur is False or cur is None:
+                return False
+            return {'>': cur > value, '<': cur < value, '>=': cur >= value, '<=': cur <= value}[op]
+        if op in ('ilike', 'like', '=ilike'):
+            text = str(cur or '')
+            if op == 'ilike':
+                return str(value).lower() in text.lower()
+            if op == '=ilike':
+                return str(value).lower() == text.lower()
+            return str(value) in text
+        raise xmlrpc.client.Fault(2, f"Operator {op} not supported")
+
+    def _match(self, model, rec, domain):
+        stack = []
+        for token in reversed(list(domain or [])):
+            if token == '&':
+                a, b = stack.pop(), stack.pop()
+                stack.append(a and b)
+            elif token == '|':
+                a, b = stack.pop(), stack.pop()
+                stack.append(a or b)
+            elif token == '!':
+                stack.append(not stack.pop())
+            else:
+                stack.append(self._leaf(model, rec, token))
+        return all(stack)
+
+    def _search(self, model, domain, offset=0, limit=None, order=None, context=None):
+        records = self.data.models[model].values()
+        if model == 'product.product' and not (context or {}).get('active_test') is False:
+            records = [r for r in records if r.get('active', True)]
+        rows = [r for r in records if self._match(model, r, domain)]
+        rows.sort(key=lambda r: r['id'], reverse=bool(order and 'desc' in order.lower()))
+        if order and order.split()[0] not in ('id',):
+            key = order.split()[0]
+            rows.sort(key=lambda r: (r.get(key) or ''), reverse='desc' in order.lower())
+        rows = rows[offset or 0:]
+        if limit:
+            rows = rows[:limit]
+        return rows
+
+    def _render(self, model, rec, fields, context=None):
+        if not fields:
+            fields = [f for f in rec if f != 'id']
+        out = {'id': rec['id']}
+        for f in fields:
+            if f == 'id':
+                continue
+            rel = self._relation(model, f)
+            val = self._value(model, rec, f, context)
+            if rel and val:
+                val = _m2o(self.data.models[rel].get(val))
+            out[f] = val
+        return out
+
+    def _m_search_read(self, model, domain=None, fields=None, offset=0, limit=None, order=None,
+                       context=None):
+        rows = self._search(model, domain or [], offset, limit, order, context)
+        return [self._render(model, r, fields, context) for r in rows]
+
+    def _m_search(self, model, domain=None, offset=0, limit=None, order=None, context=None):
+        return [r['id'] for r in self._search(model, domain or [], offset, limit, order, context)]
+
+    def _m_search_count(self, model, domain=None, context=None):
+        return len(self._search(model, domain or [], context=context))
+
+    def _m_read(self, model, ids, fields=None, context=None):
+        table = self.data.models[model]
+        return [self._render(model, table[i], fields, context) for i in ids if i in table]
+
+    def _m_read_group(self, model, domain, fields, groupby, offset=0, limit=None, orderby=False,
+                      lazy=True, context=None):
+        if isinstance(groupby, str):
+            groupby = [groupby]
+        if lazy and len(groupby) > 1:
+            groupby = groupby[:1]
+        aggregates = []
+        for spec in fields:
+            name, _, func = spec.partition(':')
+            if func:
+                aggregates.append((name, func))
+        groups = {}
+        for rec in self._search(model, domain, context=context):
+            key = tuple(rec.get(g) for g in groupby)
+            grp = groups.setdefault(key, {'__count': 0, 'values': defaultdict(list)})
+            grp['__count'] += 1
+            for name, func in aggregates:
+                grp['values'][(name, func)].append(self._value(model, rec, name))
+        out = []
+        for key, grp in groups.items():
+            row = {'__count': grp['__count'], '__domain': []}
+            for g, v in zip(groupby, key):
+                rel = self._relation(model, g)
+                row[g] = _m2o(self.data.models[rel].get(v)) if rel and v else v
+            for name, func in aggregates:
+                vals = grp['values'][(name, func)]
+                row[name] = {'sum': sum, 'max': max, 'min': min}[func](vals)
+            out.append(row)
+        out = out[offset or 0:]
+        return out[:limit] if limit else out
+
+
+class _Handler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ()
+
+    def do_POST(self):
+        if self.path != '/jsonrpc':
+            return super().do_POST()
+
+        # /jsonrpc kiểu Odoo: {"params": {"service", "method", "args"}}
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length))
+        params = request.get('params') or {}
+        reply = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            fake = self.server.fake
+            target = fake if params.get('service') in ('common', 'object') else None
+            fn = getattr(target, params.get('method') or '', None)
+            if fn is None:
+                raise xmlrpc.client.Fault(2, f"Method {params.get('method')} not found")
+            reply['result'] = fn(*(params.get('args') or []))
+        except xmlrpc.client.Fault as e:
+            name = e.faultString.split(':', 1)[0] if 'odoo.exceptions' in e.faultString else ''
+            reply['error'] = {
+                'code': 200, 'message': 'Odoo Server Error',
+                'data': {'name': name, 'message': e.faultString},
+            }
+        except Exception as e:
+            reply['error'] = {
+                'code': 200, 'message': 'Odoo Server Error',
+                'data': {'name': type(e).__name__, 'message': str(e)},
+            }
+
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > self.encode_threshold:
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class _Server(ThreadingMixIn, MultiPathXMLRPCServer):
+    daemon_threads = True
+
+
+def serve(fake, host='127.0.0.1', port=0, background=True):
+    server = _Server((host, port), requestHandler=_Handler, logRequests=False, allow_none=True)
+    common = SimpleXMLRPCDispatcher(allow_none=True)
+    common.register_function(fake.authenticate, 'authenticate')
+    common.register_function(fake.version, 'version')
+    obj = SimpleXMLRPCDispatcher(allow_none=True)
+    obj.register_function(fake.execute_kw, 'execute_kw')
+    server.add_dispatcher('/xmlrpc/2/common', common)
+    server.add_dispatcher('/xmlrpc/2/object', obj)
+    server.add_dispatcher('/bench', _control_dispatcher(fake))
+    server.fake = fake
+    url = f"http://{host}:{server.server_address[1]}"
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, url
+
+
+def _control_dispatcher(fake):
+    control = SimpleXMLRPCDispatcher(allow_none=True)
+
+    def load(n_products, quants_per_location=1, seed=1):
+        fake.data = FakeDataset(n_products=n_products,
+                                quants_per_location=quants_per_location, seed=seed)
+        fake.reset_counters()
+        return True
+
+    def reset_counters():
+        fake.reset_counters()
+        return True
+
+    def set_latency(seconds):
+        fake.latency = float(seconds)
+        return True
+
+    def receive(product_ids, location_id=10, qty=5.0, backdate=0):
+        fake.data.receive(product_ids, location_id, qty, backdate)
+        return True
+
+    control.register_function(load, 'load')
+    control.register_function(reset_counters, 'reset_counters')
+    control.register_function(fake.calls_by_method, 'calls')
+    control.register_function(set_latency, 'set_latency')
+    control.register_function(receive, 'receive')
+    return control
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Odoo XML-RPC giả cho benchmark")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8069)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help="giây trễ thêm cho mỗi RPC")
+    opts = parser.parse_args()
+
+    fake_odoo = FakeOdoo(FakeDataset(n_products=opts.products), latency=opts.latency)
+    srv, srv_url = serve(fake_odoo, opts.host, opts.port, background=False)
+    print(f"Odoo giả chạy tại {srv_url} (db={FAKE_DB}, user={FAKE_USER}, pass={FAKE_PASSWORD})", flush=True)
+    srv.serve_forever()
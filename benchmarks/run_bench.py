@@ -0,0 +1,242 @@
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import xmlrpc.client
+
+import openpyxl
+import pandas  # noqa: F401  bot import pandas lúc cần; nạp trước để không tính vào kịch bản đầu
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_odoo import FAKE_DB, FAKE_PASSWORD, FAKE_USER  # noqa: E402
+
+BASELINE_FILE = os.path.join(HERE, 'baseline.json')
+
+
+# ---------------- Odoo giả chạy ở process riêng ----------------
+# Tách process để thời gian / bộ nhớ đo được chỉ là của bot
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_odoo(latency):
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'fake_odoo.py'), '--port', str(port),
+         '--products', '1', '--latency', str(latency)],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    control = xmlrpc.client.ServerProxy(f"{url}/bench", allow_none=True)
+    for _ in range(100):
+        try:
+            control.reset_counters()
+            return proc, url, control
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise SystemExit("Không khởi động được Odoo giả")
+
+
+def import_bot(url):
+    os.environ.update(
+        ODOO_URL=url, ODOO_DB=FAKE_DB, ODOO_USERNAME=FAKE_USER, ODOO_PASSWORD=FAKE_PASSWORD,
+        TELEGRAM_TOKEN=os.environ.get('TELEGRAM_TOKEN', '0:bench'), STATE_DB='',
+    )
+    import main
+    return main
+
+
+def reset_bot_state(main):
+    # Bỏ toàn bộ cache để mỗi cỡ dữ liệu bắt đầu lạnh
+    main.LOCATION_REGISTRY = main.LocationRegistry()
+    main.INVENTORY = main.InventoryStore()
+    main.PRODUCT_CATALOG = main.ProductCatalog()
+    main.previous_snapshot = {}
+    main.watch_cursors = {}
+    main.last_full_sync = 0.0
+    main.watch_location_id = None
+
+
+def make_po(n_lines, n_products, seed=3):
+    rnd = random.Random(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Đơn đặt hàng', None, None])
+    ws.append(['STT', 'Model', 'Tên', 'SL', 'ĐV nhận'])
+    for i in range(n_lines):
+        pid = rnd.randint(1, int(n_products * 1.05) + 1)
+        ws.append([i + 1, f"sp{pid:06d}", 'x', rnd.randint(1, 80), f"CH{rnd.randint(1, 5)}"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+# ---------------- Kịch bản ----------------
+def scenarios(main, control, n_products):
+    po_bytes = make_po(min(n_products, main.PO_MAX_ROWS), n_products)
+    codes = [f"SP{random.Random(i).randint(1, n_products):06d}" for i in range(20)] + ['KHONGCO']
+    tz = main.pytz.timezone("Asia/Ho_Chi_Minh")
+
+    def keohang(fresh=False):
+        buf, count, msg = main.get_stock_data(fresh=fresh)
+        if buf is None:
+            raise RuntimeError(msg)
+
+    def checkpo(fresh=False):
+        out, err = main.process_po_and_build_report(po_bytes, fresh=fresh)
+        if out is None:
+            raise RuntimeError(err)
+
+    def lookups():
+        for code in codes:
+            main.lookup_product_stock(code)
+
+    def watchdog_change():
+        control.receive(list(range(1, min(n_products, 10) + 1)))
+        control.reset_counters()
+        main.watchdog_cycle(tz)
+
+    def watchdog_recover():
+        # Vòng lỗi sau khi đã poll (ở đây: enrich lỗi) không được làm mất SP
+        # đổi trước con trỏ mới: vòng kế phải báo đủ cả 3 SP
+        enrich = main.enrich_watch_changes
+        seen = []
+
+        def flaky(models, uid, pids):
+            if not seen:
+                seen.append(None)
+                raise RuntimeError("enrich lỗi giả")
+            seen.extend(pids)
+            return enrich(models, uid, pids)
+
+        control.receive([3])
+        control.receive([4])
+        main.enrich_watch_changes = flaky
+        try:
+            try:
+                main.watchdog_cycle(tz)
+            except RuntimeError:
+                pass
+            control.receive([9])
+            control.reset_counters()
+            main.watchdog_cycle(tz)
+        finally:
+            main.enrich_watch_changes = enrich
+        if sorted(seen[1:]) != [3, 4, 9]:
+            raise RuntimeError(f"watchdog bỏ sót SP sau vòng lỗi: {seen[1:]}")
+
+    def watchdog_late_commit():
+        # Lệnh kho commit sau khi con trỏ đã dời qua write_date của nó
+        control.receive([11])
+        main.watchdog_cycle(tz)
+        control.receive([12], 10, 5.0, 60)
+        control.reset_counters()
+        if main.watchdog_cycle(tz) != 1:
+            raise RuntimeError("watchdog bỏ sót thay đổi commit muộn")
+
+    return [
+        ('keohang_cold', keohang),
+        ('keohang_warm', keohang),
+        ('keohang_fresh', lambda: keohang(fresh=True)),
+        ('checkpo', checkpo),
+        ('checkpo_fresh', lambda: checkpo(fresh=True)),
+        ('lookup_x21', lookups),
+        ('watchdog_first', lambda: main.watchdog_cycle(tz)),
+        ('watchdog_idle', lambda: main.watchdog_cycle(tz)),
+        ('watchdog_change', watchdog_change),
+        ('watchdog_recover', watchdog_recover),
+        ('watchdog_late_commit', watchdog_late_commit),
+    ]
+
+
+def measure(fn, control):
+    control.reset_counters()
+    tracemalloc.start()
+    wall = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - wall
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = control.calls()
+    return wall, sum(calls.values()), peak, calls
+
+
+def run(sizes, latency, verbose=False):
+    proc, url, control = start_fake_odoo(latency)
+    try:
+        main = import_bot(url)
+        main.connect_odoo()  # đăng nhập trước để không tính vào kịch bản đầu
+        results = {}
+        for n in sizes:
+            control.load(n)
+            reset_bot_state(main)
+            for name, fn in scenarios(main, control, n):
+                wall, rpc, peak, calls = measure(fn, control)
+                key = f"{name}@{n}"
+                results[key] = {'wall_s': round(wall, 4), 'rpc': rpc, 'peak_mb': round(peak / 1e6, 2)}
+                print(f"{key:<24} {wall:>9.3f}s {rpc:>6} RPC {peak / 1e6:>9.1f} MB", flush=True)
+                if verbose:
+                    for method, count in sorted(calls.items()):
+                        print(f"{'':<26}{method}: {count}")
+        return results
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def check_baseline(results, baseline):
+    # Chỉ chặn khi số RPC tăng; thời gian chạy chỉ để tham khảo
+    regressions = []
+    for key, res in results.items():
+        expected = baseline.get(key, {}).get('rpc')
+        if expected is not None and res['rpc'] > expected:
+            regressions.append(f"{key}: {res['rpc']} RPC (baseline {expected})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bot với Odoo giả")
+    parser.add_argument('sizes', nargs='*', type=int, default=[200, 2000])
+    parser.add_argument('--latency', type=float, default=0.0, help="giây trễ thêm cho mỗi RPC")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--json', help="ghi kết quả ra file JSON")
+    parser.add_argument('-v', '--verbose', action='store_true', help="in số RPC theo model.method")
+    opts = parser.parse_args()
+
+    print(f"{'kịch bản':<24} {'thời gian':>10} {'RPC':>10} {'peak':>12}")
+    results = run(opts.sizes, opts.latency, opts.verbose)
+
+    if opts.json:
+        with open(opts.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if opts.update_baseline:
+        baseline = {}
+        if os.path.exists(opts.baseline):
+            with open(opts.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        baseline.update({key: {'rpc': res['rpc']} for key, res in results.items()})
+        with open(opts.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Đã cập nhật {opts.baseline}")
+    elif os.path.exists(opts.baseline):
+        with open(opts.baseline, encoding='utf-8') as f:
+            failed = check_baseline(results, json.load(f))
+        if failed:
+            print("Số RPC tăng so với baseline:\n  " + "\n  ".join(failed))
+            sys.exit(1)
+        print("Số RPC không vượt baseline.")
@@ -1,18 +1,35 @@
 import os
 import io
 import logging
-import pandas as pd
+import queue
+import http.client
+import importlib
 import ssl
 import xmlrpc.client
 import asyncio
+import atexit
 import socket
 import threading
 import time
 import urllib.request
-from datetime import datetime
+import concurrent.futures
+import contextlib
+import contextvars
+import bisect
+import csv
+import difflib
+import gzip
+import hashlib
+import itertools
+import json
+import sqlite3
+import tempfile
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from telegram import Update, Bot
+from telegram import Update, Bot, InputFile
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import pytz
 
@@ -31,20 +48,32 @@ ODOO_PASSWORD = os.environ.get('ODOO_PASSWORD')
 
 TARGET_MIN_QTY = 50
 
-LOCATION_MAP = {
-    'HN_STOCK_CODE': '201/201',
-    'HCM_STOCK_CODE': '124/124',
-    'HN_TRANSIT_NAME': 'Kho nhập Hà Nội',
-}
-
-PRIORITY_LOCATIONS = [
-    LOCATION_MAP['HN_STOCK_CODE'],
-    LOCATION_MAP['HN_TRANSIT_NAME'],
-    LOCATION_MAP['HCM_STOCK_CODE'],
+# Các kho theo dõi tồn, theo thứ tự cột báo cáo. Ghi đè bằng STOCK_LOCATIONS (JSON cùng dạng).
+#   key: mã nội bộ; match: chuỗi tìm trong tên kho Odoo; label: tên ngắn; name: tên cột /keohang
+#   role: local = kho cần đủ TARGET_MIN_QTY (PO lấy lần lượt theo thứ tự),
+#         source = kho để kéo hàng về, info = chỉ hiển thị
+#   measure: số dùng cho /keohang (available = có hàng, on_hand = hiện có)
+#   status: trạng thái /checkpo khi PO đủ hàng tính đến kho này
+DEFAULT_STOCK_LOCATIONS = [
+    {'key': 'HN_STOCK', 'match': '201/201', 'label': 'HN', 'name': 'Tồn Kho HN',
+     'role': 'local', 'measure': 'available', 'status': 'ĐỦ tại kho HN (201/201)'},
+    {'key': 'HCM_STOCK', 'match': '124/124', 'label': 'HCM', 'name': 'Tồn Kho HCM',
+     'role': 'source', 'measure': 'available', 'status': 'CẦN KÉO HÀNG TỪ HCM'},
+    {'key': 'HN_TRANSIT', 'match': 'Kho nhập Hà Nội', 'label': 'Kho Nhập', 'name': 'Kho Nhập HN',
+     'role': 'local', 'measure': 'on_hand', 'status': 'ĐỦ (HN + Kho nhập HN)'},
 ]
+# Tên chung của nhóm kho local ("Tổng tồn HN")
+LOCAL_GROUP_LABEL = os.environ.get('LOCAL_GROUP_LABEL', 'HN')
 
 PRODUCT_CODE_FIELD = 'default_code'
 
+# Mốc đo thời gian khởi động (sau khi import thư viện)
+BOT_STARTED_AT = time.perf_counter()
+
+# pandas / numpy / openpyxl chỉ import khi lần đầu cần (báo cáo, đọc PO);
+# BOT_LAZY_IMPORTS=0: import ngay khi nạp module như trước
+BOT_LAZY_IMPORTS = os.environ.get('BOT_LAZY_IMPORTS', '1').strip().lower() not in ('0', 'false', 'no')
+
 # ---------------- Logging ----------------
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -52,6 +81,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ---------------- Lazy imports ----------------
+LAZY_IMPORT_SECONDS = {}
+
+
+class _LazyModule:
+    # Đứng thay module; lần truy cập đầu import thật rồi thay tên toàn cục bằng module đó,
+    # các lần sau không còn đi qua lớp này
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def load(self):
+        started = time.perf_counter()
+        module = importlib.import_module(self._name)
+        if globals().get(self._alias) is self:
+            globals()[self._alias] = module
+            LAZY_IMPORT_SECONDS[self._name] = round(time.perf_counter() - started, 4)
+            logger.info(f"Đã import {self._name} sau {LAZY_IMPORT_SECONDS[self._name]:.2f}s")
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+np = _LazyModule('numpy', 'np')
+pd = _LazyModule('pandas', 'pd')
+openpyxl = _LazyModule('openpyxl', 'openpyxl')
+
+if not BOT_LAZY_IMPORTS:
+    for _lazy in (np, pd, openpyxl):
+        _lazy.load()
+
+
+# ---------------- Background services ----------------
+# Luồng nền được đăng ký cạnh hàm của chúng nhưng chỉ chạy khi main() gọi
+# SERVICES.start(); import main không mở cổng, không gọi Odoo.
+class ServiceRegistry:
+    def __init__(self):
+        self._targets = OrderedDict()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, target):
+        self._targets[name] = target
+
+    def start(self, names=None):
+        started = []
+        with self._lock:
+            for name, target in self._targets.items():
+                if names is not None and name not in names:
+                    continue
+                thread = self._threads.get(name)
+                if thread is not None and thread.is_alive():
+                    continue
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads[name] = thread
+                started.append(name)
+        logger.info(f"Đã chạy luồng nền: {', '.join(started)}")
+        return started
+
+    def status(self):
+        with self._lock:
+            return {
+                name: name in self._threads and self._threads[name].is_alive()
+                for name in self._targets
+            }
+
+
+SERVICES = ServiceRegistry()
+
+
 # ---------------- Keep port open (Render free) ----------------
 def keep_port_open():
     try:
@@ -64,28 +165,512 @@ def keep_port_open():
     except Exception:
         pass
 
-threading.Thread(target=keep_port_open, daemon=True).start()
+SERVICES.register('keep_port', keep_port_open)
+
+# ---------------- Metrics ----------------
+# Bộ đếm / histogram nhỏ, xuất dạng Prometheus text ở /metrics (cổng 10001)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Lệnh Telegram / luồng nền đang chạy, dùng làm nhãn cho số liệu RPC
+CURRENT_COMMAND = contextvars.ContextVar('current_command', default='background')
+
+
+@contextlib.contextmanager
+def command_scope(name):
+    token = CURRENT_COMMAND.set(name)
+    try:
+        yield
+    finally:
+        CURRENT_COMMAND.reset(token)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = OrderedDict()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._callbacks = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._meta[name][2]
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def add_callback(self, fn):
+        # fn() -> [(name, labels dict, value)], gọi lúc render cho số liệu dạng gauge
+        self._callbacks.append(fn)
+
+    def render(self):
+        for fn in self._callbacks:
+            try:
+                for name, labels, value in fn():
+                    self.set(name, value, **labels)
+            except Exception as e:
+                logger.warning(f"Lỗi lấy số liệu metrics: {e}")
+
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (n, labels), (counts, total, count) in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, c in zip(buckets, counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_label_text(labels)} {total}")
+                    lines.append(f"{name}_count{_label_text(labels)} {count}")
+            else:
+                source = counters if kind == 'counter' else gauges
+                for (n, labels), value in sorted(source.items()):
+                    if n == name:
+                        lines.append(f"{name}{_label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe('odoo_rpc_calls_total', 'counter',
+                 "Số lệnh gọi Odoo theo model, method, lệnh và kết quả")
+METRICS.describe('odoo_rpc_duration_seconds', 'histogram',
+                 "Thời gian mỗi lệnh gọi Odoo", LATENCY_BUCKETS)
+METRICS.describe('odoo_rpc_request_bytes', 'histogram',
+                 "Kích thước request XML-RPC gửi đi", SIZE_BUCKETS)
+METRICS.describe('odoo_rpc_response_bytes', 'histogram',
+                 "Kích thước response XML-RPC nhận về", SIZE_BUCKETS)
+METRICS.describe('odoo_connections_total', 'counter',
+                 "Kết nối HTTP tới Odoo: opened / reused / dropped")
+METRICS.describe('bot_command_duration_seconds', 'histogram',
+                 "Thời gian xử lý mỗi lệnh trong worker", LATENCY_BUCKETS)
+METRICS.describe('watchdog_cycle_duration_seconds', 'histogram',
+                 "Thời gian một vòng watchdog 201/201", LATENCY_BUCKETS)
+METRICS.describe('watchdog_lag_seconds', 'gauge',
+                 "Số giây từ lần watchdog chạy xong gần nhất")
+METRICS.describe('watchdog_changes_total', 'counter',
+                 "Số SP thay đổi tồn watchdog phát hiện")
+METRICS.describe('worker_queue', 'gauge', "Việc đang chờ / đang chạy trong pool worker")
+METRICS.describe('notify_messages', 'gauge', "Tin nhắn thông báo: sent / failed / dropped")
+METRICS.describe('inventory_snapshot_age_seconds', 'gauge', "Tuổi của snapshot tồn kho dùng chung")
+METRICS.describe('bot_service_up', 'gauge', "Luồng nền đang chạy (1) hay đã dừng / chưa chạy (0)")
+METRICS.describe('bot_lazy_import_seconds', 'gauge', "Thời gian import lần đầu của thư viện nạp trễ")
+
 
 # ---------------- Odoo connect ----------------
+ODOO_POOL_SIZE = int(os.environ.get('ODOO_POOL_SIZE', '4'))
+ODOO_POOL_TIMEOUT = float(os.environ.get('ODOO_POOL_TIMEOUT', '60'))
+# xmlrpc (mặc định) hoặc jsonrpc (/jsonrpc của Odoo, nhẹ và parse nhanh hơn)
+ODOO_PROTOCOL = os.environ.get('ODOO_PROTOCOL', 'xmlrpc').strip().lower()
+ODOO_GZIP = os.environ.get('ODOO_GZIP', '1').strip().lower() not in ('0', 'false', 'no')
+ODOO_HTTP_TIMEOUT = float(os.environ.get('ODOO_HTTP_TIMEOUT', '120'))
+
+
+class OdooSessionError(Exception):
+    pass
+
+
+class _CountingResponse:
+    # Bọc HTTPResponse để đếm số byte parse_response đọc được
+    def __init__(self, response):
+        self._response = response
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def getheader(self, *args):
+        return self._response.getheader(*args)
+
+
+class _KeepAliveTransportMixin:
+    # xmlrpc.client.Transport giữ lại 1 kết nối HTTP/1.1 cho mỗi host,
+    # ở đây đếm số lần mở mới / tái sử dụng và kích thước request / response.
+    # Mỗi proxy chỉ được 1 luồng dùng tại một thời điểm (pool) nên
+    # last_request_bytes / last_response_bytes không bị lẫn.
+    last_request_bytes = 0
+    last_response_bytes = 0
+
+    def make_connection(self, host):
+        reused = bool(self._connection and host == self._connection[0])
+        conn = super().make_connection(host)
+        if self.stats is not None:
+            self.stats.incr('connections_reused' if reused else 'connections_opened')
+        return conn
+
+    def send_content(self, connection, request_body):
+        self.last_request_bytes = len(request_body)
+        return super().send_content(connection, request_body)
+
+    def parse_response(self, response):
+        counting = _CountingResponse(response)
+        try:
+            return super().parse_response(counting)
+        finally:
+            self.last_response_bytes = counting.bytes_read
+
+
+class _KeepAliveTransport(_KeepAliveTransportMixin, xmlrpc.client.Transport):
+    def __init__(self, stats=None):
+        super().__init__()
+        self.stats = stats
+
+
+class _KeepAliveSafeTransport(_KeepAliveTransportMixin, xmlrpc.client.SafeTransport):
+    def __init__(self, stats=None):
+        super().__init__(context=ssl._create_unverified_context())
+        self.stats = stats
+
+
+# Proxy JSON-RPC tới /jsonrpc của Odoo, dùng thay ServerProxy được:
+# proxy.authenticate(...), proxy.execute_kw(...), proxy('close')().
+# Giữ 1 kết nối HTTP/1.1 keep-alive, nhận response gzip; lỗi Odoo được đổi
+# thành xmlrpc.client.Fault để phần retry / đăng nhập lại dùng chung.
+class _JsonRpcProxy:
+    def __init__(self, url, service, stats=None, gzip_enabled=ODOO_GZIP):
+        parsed = urlparse(url)
+        self.service = service
+        self.stats = stats
+        self.gzip_enabled = gzip_enabled
+        self._https = parsed.scheme == 'https'
+        self._host = parsed.netloc
+        self._path = (parsed.path or '').rstrip('/') + '/jsonrpc'
+        self._conn = None
+        self._seq = 0
+        self.last_request_bytes = 0
+        self.last_response_bytes = 0
+        self._bot_transport = self
+
+    def __call__(self, attr):
+        if attr == 'close':
+            return self.close
+        raise AttributeError(attr)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, args)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connection(self):
+        if self._conn is not None:
+            if self.stats is not None:
+                self.stats.incr('connections_reused')
+            return self._conn
+        if self._https:
+            self._conn = http.client.HTTPSConnection(
+                self._host, timeout=ODOO_HTTP_TIMEOUT, context=ssl._create_unverified_context()
+            )
+        else:
+            self._conn = http.client.HTTPConnection(self._host, timeout=ODOO_HTTP_TIMEOUT)
+        if self.stats is not None:
+            self.stats.incr('connections_opened')
+        return self._conn
+
+    def _call(self, method, args):
+        self._seq += 1
+        body = json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': self.service, 'method': method, 'args': list(args)},
+            'id': self._seq,
+        }).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.gzip_enabled:
+            headers['Accept-Encoding'] = 'gzip'
+
+        self.last_request_bytes = len(body)
+        conn = self._connection()
+        try:
+            conn.request('POST', self._path, body, headers)
+            response = conn.getresponse()
+            raw = response.read()
+        except Exception:
+            self.close()
+            raise
+        self.last_response_bytes = len(raw)
+
+        if response.status != 200:
+            self.close()
+            raise xmlrpc.client.ProtocolError(
+                self._host + self._path, response.status, response.reason, dict(response.getheaders())
+            )
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            raw = gzip.decompress(raw)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+
+        reply = json.loads(raw)
+        error = reply.get('error')
+        if error:
+            data = error.get('data') or {}
+            name = data.get('name') or ''
+            message = data.get('message') or error.get('message') or ''
+            code = 3 if 'AccessDenied' in name or 'SessionExpired' in name else error.get('code', 1)
+            raise xmlrpc.client.Fault(code, f"{name}: {message}" if name else message)
+        return reply.get('result')
+
+
+class _OdooStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {
+            'logins': 0,
+            'relogins': 0,
+            'calls': 0,
+            'connections_opened': 0,
+            'connections_reused': 0,
+            'connections_dropped': 0,
+        }
+
+    def incr(self, key, n=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + n
+        if key.startswith('connections_'):
+            METRICS.inc('odoo_connections_total', n, state=key[len('connections_'):])
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+def _is_session_error(fault):
+    text = str(getattr(fault, 'faultString', '') or '')
+    return (
+        getattr(fault, 'faultCode', None) == 3
+        or 'AccessDenied' in text
+        or 'Access Denied' in text
+        or 'Session expired' in text
+        or 'SessionExpired' in text
+    )
+
+
+# write_date của Odoo là giờ bắt đầu transaction, không phải giờ commit: một lệnh kho
+# chạy lâu commit các dòng mang giờ cũ hơn con trỏ đã dời. Các truy vấn tăng dần theo
+# write_date lùi con trỏ thêm ODOO_CURSOR_OVERLAP giây (đọc trùng vô hại).
+ODOO_CURSOR_OVERLAP = int(os.environ.get('ODOO_CURSOR_OVERLAP', '300'))
+ODOO_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def write_date_since(cursor, overlap=None):
+    overlap = ODOO_CURSOR_OVERLAP if overlap is None else overlap
+    try:
+        start = datetime.strptime(str(cursor)[:19], ODOO_DATETIME_FORMAT)
+    except ValueError:
+        return cursor
+    return (start - timedelta(seconds=overlap)).strftime(ODOO_DATETIME_FORMAT)
+
+
+# Phiên Odoo dùng chung: uid được cache, pool kết nối keep-alive an toàn đa luồng.
+# execute_kw() giữ nguyên chữ ký của ServerProxy.execute_kw để các chỗ gọi cũ không
+# phải sửa; db/uid/password truyền vào được bỏ qua, luôn dùng phiên hiện tại.
+class OdooClient:
+    def __init__(self, url, db, username, password, pool_size=ODOO_POOL_SIZE,
+                 protocol=ODOO_PROTOCOL, gzip_enabled=ODOO_GZIP):
+        self.url = url
+        self.db = db
+        self.username = username
+        self.password = password
+        self.pool_size = max(1, pool_size)
+        self.protocol = protocol
+        self.gzip_enabled = gzip_enabled
+        self.stats = _OdooStats()
+
+        self._uid = None
+        self._auth_lock = threading.Lock()
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._created = 0
+
+    def _make_transport(self):
+        if urlparse(self.url).scheme == 'https':
+            transport = _KeepAliveSafeTransport(self.stats)
+        else:
+            transport = _KeepAliveTransport(self.stats)
+        transport.accept_gzip_encoding = self.gzip_enabled
+        return transport
+
+    def _new_proxy(self, service):
+        if self.protocol == 'jsonrpc':
+            return _JsonRpcProxy(self.url, service, self.stats, self.gzip_enabled)
+
+        transport = self._make_transport()
+        proxy = xmlrpc.client.ServerProxy(
+            f"{self.url}/xmlrpc/2/{service}",
+            transport=transport,
+            allow_none=True,
+        )
+        proxy._bot_transport = transport
+        return proxy
+
+    def _record(self, proxy, model, method, status, started):
+        command = CURRENT_COMMAND.get()
+        METRICS.inc('odoo_rpc_calls_total', model=model, method=method,
+                    command=command, status=status)
+        METRICS.observe('odoo_rpc_duration_seconds', time.perf_counter() - started,
+                        model=model, method=method, command=command)
+        transport = proxy._bot_transport
+        METRICS.observe('odoo_rpc_request_bytes', transport.last_request_bytes,
+                        model=model, method=method)
+        if status == 'ok':
+            METRICS.observe('odoo_rpc_response_bytes', transport.last_response_bytes,
+                            model=model, method=method)
+
+    # ---------- session ----------
+    @property
+    def uid(self):
+        return self._uid
+
+    def authenticate(self, force=False):
+        with self._auth_lock:
+            if self._uid and not force:
+                return self._uid
+
+            common = self._new_proxy('common')
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                uid = common.authenticate(self.db, self.username, self.password, {})
+                status = 'ok'
+            finally:
+                self._record(common, 'common', 'authenticate', status, started)
+                common('close')()
+
+            self.stats.incr('relogins' if self._uid or force else 'logins')
+            if not uid:
+                self._uid = None
+                raise OdooSessionError("Đăng nhập thất bại. Kiểm tra DB/user/pass.")
+            self._uid = uid
+            return uid
+
+    def invalidate(self):
+        with self._auth_lock:
+            self._uid = None
+
+    # ---------- pool ----------
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                return self._new_proxy('object')
+
+        try:
+            return self._pool.get(timeout=ODOO_POOL_TIMEOUT)
+        except queue.Empty:
+            raise OdooSessionError("Hết kết nối Odoo trong pool, vui lòng thử lại sau.")
+
+    def _release(self, proxy, broken=False):
+        if broken:
+            # Bỏ kết nối HTTP hỏng, proxy sẽ tự mở lại ở lần gọi sau
+            proxy('close')()
+            self.stats.incr('connections_dropped')
+        self._pool.put(proxy)
+
+    def execute_kw(self, db, uid, password, model, method, args=None, kw=None):
+        session_uid = self.authenticate()
+        retried = False
+
+        while True:
+            proxy = self._acquire()
+            broken = False
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                self.stats.incr('calls')
+                result = proxy.execute_kw(
+                    self.db, session_uid, self.password,
+                    model, method, args or [], kw or {}
+                )
+                status = 'ok'
+                return result
+            except xmlrpc.client.Fault as e:
+                status = 'session_error' if _is_session_error(e) else 'fault'
+                if retried or not _is_session_error(e):
+                    raise
+                session_uid = self.authenticate(force=True)
+            except (xmlrpc.client.ProtocolError, http.client.HTTPException, OSError):
+                status = 'connection_error'
+                broken = True
+                if retried:
+                    raise
+            finally:
+                self._record(proxy, model, method, status, started)
+                self._release(proxy, broken)
+            retried = True
+
+
+ODOO_CLIENT = None
+ODOO_CLIENT_LOCK = threading.Lock()
+
+
+def get_odoo_client():
+    global ODOO_CLIENT
+    with ODOO_CLIENT_LOCK:
+        if ODOO_CLIENT is None:
+            ODOO_CLIENT = OdooClient(ODOO_URL_FINAL, ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD)
+        return ODOO_CLIENT
+
+
 def connect_odoo():
     try:
         if not ODOO_URL_FINAL:
             return None, None, "odoo url không được thiết lập."
 
-        common = xmlrpc.client.ServerProxy(
-            f"{ODOO_URL_FINAL}/xmlrpc/2/common",
-            context=ssl._create_unverified_context()
-        )
-
-        uid = common.authenticate(ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, {})
-        if not uid:
-            return None, None, "Đăng nhập thất bại. Kiểm tra DB/user/pass."
-
-        models = xmlrpc.client.ServerProxy(
-            f"{ODOO_URL_FINAL}/xmlrpc/2/object",
-            context=ssl._create_unverified_context()
-        )
-        return uid, models, "OK"
+        client = get_odoo_client()
+        uid = client.authenticate()
+        return uid, client, "OK"
+    except OdooSessionError as e:
+        return None, None, str(e)
     except Exception as e:
         return None, None, f"Lỗi kết nối: {e}"
 
@@ -104,55 +689,807 @@ def get_odoo_url_components():
     return netloc, port
 
 # ---------------- Location helpers ----------------
-def find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD):
+LOCATION_TTL = int(os.environ.get('LOCATION_TTL', '3600'))
+
+LOCATION_ROLES = ('local', 'source', 'info')
+# Kho có hàng thật: phần "tồn kho chi tiết" khi tra mã liệt kê các kho loại này
+DETAIL_LOCATION_USAGES = ['internal', 'transit']
+LOCATION_MEASURES = ('available', 'on_hand')
+
+
+class StockLocation:
+    __slots__ = ('key', 'match', 'label', 'name', 'role', 'measure', 'status')
+
+    def __init__(self, key, match, label=None, name=None, role='local', measure='available',
+                 status=None):
+        self.key = key
+        self.match = match
+        self.label = label or key
+        self.name = name or f"Tồn {self.label}"
+        self.role = role
+        self.measure = measure
+        self.status = status
+
+
+# Tập kho cấu hình: mọi tính toán tồn (/keohang, /checkpo, tra mã) đi qua đây
+# nên thêm kho chỉ là thêm một mục cấu hình, số RPC không đổi.
+class LocationSet:
+    def __init__(self, locations):
+        self.locations = list(locations)
+        self.keys = [l.key for l in self.locations]
+        self.local = [l for l in self.locations if l.role == 'local']
+        self.sources = [l for l in self.locations if l.role == 'source']
+        # Thứ tự lấy hàng cho PO và ưu tiên hiển thị: kho local, rồi kho nguồn, rồi còn lại
+        self.priority = self.local + self.sources + [
+            l for l in self.locations if l.role not in ('local', 'source')
+        ]
+
+        for i, l in enumerate(self.local):
+            if not l.status:
+                labels = [x.label for x in self.local[:i + 1]]
+                l.status = f"ĐỦ tại kho {l.label}" if i == 0 else f"ĐỦ ({' + '.join(labels)})"
+        for l in self.sources:
+            if not l.status:
+                l.status = f"CẦN KÉO HÀNG TỪ {l.label}"
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def levels(self, cells, measure='on_hand'):
+        # {key: số đã làm tròn} từ một dòng của ma trận tồn
+        idx = 0 if measure == 'on_hand' else 1
+        return {
+            l.key: int(round(cells[l.key][idx])) if cells and l.key in cells else 0
+            for l in self.locations
+        }
+
+    def suggestion(self, levels):
+        # SL đề xuất kéo về từ kho nguồn để tổng kho local đủ TARGET_MIN_QTY
+        local_total = sum(levels.get(l.key, 0) for l in self.local)
+        source_total = sum(levels.get(l.key, 0) for l in self.sources)
+        if local_total >= TARGET_MIN_QTY:
+            return 0
+        return max(0, min(TARGET_MIN_QTY - local_total, source_total))
+
+
+def parse_stock_locations(raw):
+    entries = json.loads(raw) if raw and raw.strip() else DEFAULT_STOCK_LOCATIONS
+    locations = []
+    for e in entries:
+        if not isinstance(e, dict) or not e.get('key') or not e.get('match'):
+            raise ValueError(f"STOCK_LOCATIONS: mỗi kho cần 'key' và 'match': {e!r}")
+        try:
+            loc = StockLocation(**e)
+        except TypeError as err:
+            raise ValueError(f"STOCK_LOCATIONS: {err}") from None
+        if loc.role not in LOCATION_ROLES or loc.measure not in LOCATION_MEASURES:
+            raise ValueError(f"STOCK_LOCATIONS: role/measure không hợp lệ ở kho {loc.key}")
+        locations.append(loc)
+    for attr in ('key', 'label', 'name'):
+        if len({getattr(l, attr) for l in locations}) != len(locations):
+            raise ValueError(f"STOCK_LOCATIONS: trùng {attr}")
+    return LocationSet(locations)
+
+
+STOCK_LOCATIONS = parse_stock_locations(os.environ.get('STOCK_LOCATIONS'))
+
+REQUIRED_LOCATIONS = {l.key: l.match for l in STOCK_LOCATIONS}
+
+
+def _resolve_locations(models, uid):
+    # Một lần search_read cho tất cả kho cấu hình (OR các điều kiện ilike)
+    keys = list(REQUIRED_LOCATIONS.values())
+    domain = ['|'] * (len(keys) - 1) + [('display_name', 'ilike', k) for k in keys]
+    locs = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        'stock.location', 'search_read',
+        [domain],
+        {'fields': ['id', 'display_name', 'complete_name']}
+    )
+
     out = {}
+    for name, key in REQUIRED_LOCATIONS.items():
+        matches = [
+            l for l in locs
+            if key.lower() in (l['display_name'] or '').lower()
+            or key.lower() in (l.get('complete_name') or '').lower()
+        ]
+        if not matches:
+            continue
+        for l in matches:
+            if key.lower() in (l['display_name'] or '').lower():
+                out[name] = {'id': l['id'], 'name': l['display_name']}
+                break
+        else:
+            out[name] = {'id': matches[0]['id'], 'name': matches[0]['display_name']}
+    return out
+
+
+def _resolve_location_tree(models, uid, locations):
+    # Map mọi kho con -> kho cấu hình gần nhất (giống context 'location' của qty_available),
+    # kèm tên đầy đủ của mọi kho nội bộ cho phần tồn chi tiết; vẫn chỉ một RPC
+    root_keys = {v['id']: k for k, v in locations.items()}
+    if not root_keys:
+        return {}, {}
+
+    children = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        'stock.location', 'search_read',
+        [['|', ('id', 'child_of', list(root_keys)), ('usage', 'in', DETAIL_LOCATION_USAGES)]],
+        {'fields': ['id', 'parent_path', 'complete_name', 'display_name']}
+    )
+
+    tree = dict(root_keys)
+    names = {}
+    for l in children:
+        names[l['id']] = l.get('complete_name') or l.get('display_name') or f"ID:{l['id']}"
+        path = [int(p) for p in (l.get('parent_path') or '').strip('/').split('/') if p]
+        for loc_id in reversed(path):
+            if loc_id in root_keys:
+                tree[l['id']] = root_keys[loc_id]
+                break
+    return tree, names
+
+
+class LocationRegistry:
+    def __init__(self, ttl=LOCATION_TTL):
+        self.ttl = ttl
+        self._locations = None
+        self._tree = {}
+        self._names = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _is_complete(self):
+        return self._locations is not None and len(self._locations) == len(REQUIRED_LOCATIONS)
+
+    def refresh(self, models=None, uid=None):
+        with self._refresh_lock:
+            if models is None:
+                uid, models, err = connect_odoo()
+                if not uid:
+                    raise OdooSessionError(err)
+
+            locations = _resolve_locations(models, uid)
+            tree, names = _resolve_location_tree(models, uid, locations)
+            with self._lock:
+                self._locations = locations
+                self._tree = tree
+                self._names = names
+                self._loaded_at = time.time()
+            STATE.put(state_key('locations'), {
+                'required': REQUIRED_LOCATIONS,
+                'locations': locations,
+                'tree': list(tree.items()),
+                'names': list(names.items()),
+                'loaded_at': self._loaded_at,
+            })
+
+            missing = set(REQUIRED_LOCATIONS) - set(locations)
+            if missing:
+                logger.warning(f"Không tìm thấy kho: {sorted(missing)}")
+            return dict(locations)
+
+    def get(self, models=None, uid=None):
+        with self._lock:
+            if self._is_complete():
+                return dict(self._locations)
+        # Chưa nạp lần nào (hoặc thiếu kho) -> nạp đồng bộ một lần
+        return self.refresh(models, uid)
+
+    def tree(self, models=None, uid=None):
+        with self._lock:
+            if self._is_complete():
+                return dict(self._tree)
+        self.refresh(models, uid)
+        with self._lock:
+            return dict(self._tree)
+
+    def names(self, models=None, uid=None):
+        # {location_id: tên đầy đủ} của các kho nội bộ
+        with self._lock:
+            if self._is_complete():
+                return self._names
+        self.refresh(models, uid)
+        with self._lock:
+            return self._names
+
+    def restore(self, data):
+        # Danh sách kho đã lưu, chỉ dùng khi cấu hình kho không đổi; run() vẫn làm mới ngay
+        if not data or data.get('required') != REQUIRED_LOCATIONS or 'names' not in data:
+            return 0
+        with self._lock:
+            self._locations = data['locations']
+            self._tree = {loc_id: key for loc_id, key in data['tree']}
+            self._names = {loc_id: name for loc_id, name in data['names']}
+            self._loaded_at = data['loaded_at']
+        return len(self._locations)
+
+    def invalidate(self):
+        with self._lock:
+            self._locations = None
+            self._tree = {}
+            self._names = {}
+            self._loaded_at = 0.0
+
+    def age(self):
+        with self._lock:
+            return time.time() - self._loaded_at if self._loaded_at else None
+
+    def run(self):
+        CURRENT_COMMAND.set('locations')
+        while True:
+            try:
+                self.refresh()
+                logger.info("Đã nạp danh sách kho.")
+            except Exception as e:
+                # Giữ lại giá trị cũ nếu có, thử lại ở chu kỳ sau
+                logger.warning(f"Lỗi nạp danh sách kho: {e}")
+            time.sleep(self.ttl)
 
-    def search(key):
-        locs = models.execute_kw(
+
+LOCATION_REGISTRY = LocationRegistry()
+SERVICES.register('locations', lambda: LOCATION_REGISTRY.run())
+
+
+def find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD):
+    return LOCATION_REGISTRY.get(models, uid)
+
+# ---------------- Inventory store ----------------
+INVENTORY_REFRESH = int(os.environ.get('INVENTORY_REFRESH', '60'))
+
+
+QUANT_BATCH_SIZE = int(os.environ.get('QUANT_BATCH_SIZE', '5000'))
+QUANT_PARALLEL_PAGES = int(os.environ.get('QUANT_PARALLEL_PAGES', '1'))
+
+INVENTORY_QUANT_FIELDS = ['product_id', 'location_id', 'quantity',
+                          'reserved_quantity', 'available_quantity']
+
+# Tổng theo (SP, kho) do Odoo tính bằng read_group; lỗi thì đọc quant thô và thử lại
+# read_group sau QUANT_READ_GROUP_RETRY giây (lỗi có thể chỉ là timeout nhất thời)
+QUANT_READ_GROUP = os.environ.get('QUANT_READ_GROUP', '1').strip().lower() not in ('0', 'false', 'no')
+QUANT_READ_GROUP_RETRY = int(os.environ.get('QUANT_READ_GROUP_RETRY', str(INVENTORY_REFRESH)))
+QUANT_GROUP_FIELDS = ['quantity:sum', 'reserved_quantity:sum', 'id:min']
+quant_read_group_failed_at = 0.0
+
+
+def iter_search_read(models, uid, model, domain, fields, batch_size=None, parallel=None):
+    # Đọc search_read theo trang, yield từng lô để không giữ cả bảng trong RAM
+    # và không có request nào quá lớn. parallel <= 1: con trỏ id; parallel > 1: lấy
+    # danh sách id trước rồi tải nhiều lô id cùng lúc. Cả hai đều ổn định khi dữ liệu
+    # đang đổi (không sót / không đọc trùng dòng như phân trang offset).
+    batch_size = max(1, batch_size or QUANT_BATCH_SIZE)
+    parallel = QUANT_PARALLEL_PAGES if parallel is None else parallel
+
+    def page(extra):
+        return models.execute_kw(
             ODOO_DB, uid, ODOO_PASSWORD,
-            'stock.location', 'search_read',
-            [[('display_name', 'ilike', key)]],
-            {'fields': ['id', 'display_name', 'complete_name']}
+            model, 'search_read',
+            [list(domain) + extra],
+            {'fields': fields, 'order': 'id', 'limit': batch_size}
         )
-        if not locs:
-            return None
 
-        for l in locs:
-            if key.lower() in (l['display_name'] or '').lower():
-                return {'id': l['id'], 'name': l['display_name']}
-        return {'id': locs[0]['id'], 'name': locs[0]['display_name']}
+    if parallel <= 1:
+        last_id = 0
+        while True:
+            batch = page([('id', '>', last_id)] if last_id else [])
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]['id']
+
+    ids = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        model, 'search',
+        [list(domain)],
+        {'order': 'id'}
+    )
+    # Dòng bị xoá giữa chừng chỉ vắng khỏi lô của nó, dòng mới thêm thì chờ lần đọc sau
+    chunks = deque(ids[i:i + batch_size] for i in range(0, len(ids), batch_size))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        # Cửa sổ trượt: tối đa `parallel` lô đang tải, yield đúng thứ tự
+        inflight = deque()
+        ctx = contextvars.copy_context()
+        while chunks or inflight:
+            while chunks and len(inflight) < parallel:
+                inflight.append(pool.submit(ctx.copy().run, page, [('id', 'in', chunks.popleft())]))
+            batch = inflight.popleft().result()
+            if batch:
+                yield batch
+
+
+def _product_id_chunks(models, uid, product_ids, batch_size):
+    # Chia theo id SP thay vì offset/limit: nhóm (SP, kho) thêm / bớt giữa chừng không làm
+    # lệch các lô sau (không đọc trùng, không sót). Mỗi lô là điều kiện domain trên product_id.
+    if product_ids is not None:
+        ids = sorted(set(product_ids))
+        for i in range(0, len(ids), batch_size):
+            yield [('product_id', 'in', ids[i:i + batch_size])]
+        return
 
-    hn = search(LOCATION_MAP['HN_STOCK_CODE'])
-    if hn:
-        out['HN_STOCK'] = hn
+    last = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        'product.product', 'search',
+        [[]],
+        {'order': 'id desc', 'limit': 1, 'context': {'active_test': False}}
+    )
+    max_id = last[0] if last else 0
+    for lo in range(1, max_id + 1, batch_size):
+        yield [('product_id', '>=', lo), ('product_id', '<', lo + batch_size)]
+
+
+def iter_quant_groups(models, uid, domain, product_ids=None, batch_size=None):
+    # read_group stock.quant theo (product_id, location_id), mỗi lần một khoảng batch_size SP;
+    # mỗi nhóm thành một dòng dạng quant (quantity, reserved_quantity đã cộng) thay vì một
+    # dòng mỗi lô/kiện. 'id' = id quant nhỏ nhất của nhóm -> trong một lô sắp theo id
+    # cho cùng thứ tự với đọc quant thô. yield từng lô như iter_search_read.
+    batch_size = max(1, batch_size or QUANT_BATCH_SIZE)
+    for extra in _product_id_chunks(models, uid, product_ids, batch_size):
+        groups = models.execute_kw(
+            ODOO_DB, uid, ODOO_PASSWORD,
+            'stock.quant', 'read_group',
+            [list(domain) + extra, QUANT_GROUP_FIELDS, ['product_id', 'location_id']],
+            {'lazy': False}
+        )
+        rows = [
+            {
+                'id': g.get('id') or 0,
+                'product_id': g['product_id'],
+                'location_id': g['location_id'],
+                'quantity': g.get('quantity') or 0.0,
+                'reserved_quantity': g.get('reserved_quantity') or 0.0,
+            }
+            for g in groups if g.get('product_id') and g.get('location_id')
+        ]
+        if rows:
+            rows.sort(key=lambda r: r['id'])
+            yield rows
 
-    hcm = search(LOCATION_MAP['HCM_STOCK_CODE'])
-    if hcm:
-        out['HCM_STOCK'] = hcm
 
-    tran = search(LOCATION_MAP['HN_TRANSIT_NAME'])
-    if tran:
-        out['HN_TRANSIT'] = tran
+def _iter_inventory_quants(models, uid, product_ids=None):
+    # stock.quant của mọi kho cấu hình (kèm kho con), theo lô;
+    # mặc định Odoo cộng sẵn theo (SP, kho), mỗi lô một khoảng id SP
+    global quant_read_group_failed_at
+    location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
+    root_ids = [v['id'] for v in location_ids.values() if v.get('id')]
+    if not root_ids:
+        return iter(()), {}
 
-    return out
+    tree = LOCATION_REGISTRY.tree(models, uid)
+    domain = [('location_id', 'child_of', root_ids)]
 
-# ---------------- Kho Nhập HN – quantity ----------------
-def get_transit_quantity(models, uid, product_id, transit_location_id):
-    if not transit_location_id:
-        return 0
+    if QUANT_READ_GROUP and time.time() - quant_read_group_failed_at >= QUANT_READ_GROUP_RETRY:
+        batches = iter_quant_groups(models, uid, domain, product_ids)
+        try:
+            # Lô đầu đọc ngay để lỗi read_group (phiên bản / quyền / timeout) còn chuyển
+            # được sang đọc quant thô; lỗi ở lô sau thì cả lần đọc lỗi, lần sau đọc lại
+            first = next(batches, None)
+        except xmlrpc.client.Fault as e:
+            if _is_session_error(e):
+                raise
+            quant_read_group_failed_at = time.time()
+            logger.warning(f"read_group stock.quant lỗi, đọc quant thô "
+                           f"(thử lại sau {QUANT_READ_GROUP_RETRY}s): {e}")
+        else:
+            quant_read_group_failed_at = 0.0
+            return itertools.chain([first] if first else [], batches), tree
 
-    quant_data = models.execute_kw(
-        ODOO_DB, uid, ODOO_PASSWORD,
-        'stock.quant', 'search_read',
-        [[('product_id', '=', product_id),
-          ('location_id', '=', transit_location_id)]],
-        {'fields': ['quantity']}
+    if product_ids is not None:
+        domain.append(('product_id', 'in', sorted(set(product_ids))))
+    return iter_search_read(models, uid, 'stock.quant', domain, INVENTORY_QUANT_FIELDS), tree
+
+
+def load_inventory(models, uid, product_ids=None):
+    # Ma trận tồn {product_id: {location_key: [on_hand, available]}},
+    # kho con được cộng về kho cấu hình
+    batches, tree = _iter_inventory_quants(models, uid, product_ids)
+
+    matrix = {}
+    for quant_data in batches:
+        for q in quant_data:
+            if not q.get('product_id') or not q.get('location_id'):
+                continue
+            key = tree.get(q['location_id'][0])
+            if not key:
+                continue
+
+            on_hand = float(q.get('quantity') or 0)
+            if q.get('available_quantity') is not None:
+                available = float(q.get('available_quantity') or 0)
+            else:
+                available = on_hand - float(q.get('reserved_quantity') or 0)
+
+            cell = matrix.setdefault(q['product_id'][0], {}).setdefault(key, [0.0, 0.0])
+            cell[0] += on_hand
+            cell[1] += available
+    return matrix
+
+
+def load_stock_details(models, uid, product_id):
+    # Tồn khả dụng của một SP theo từng kho nội bộ {location_id: available} (chỉ kho > 0),
+    # đọc lúc tra mã bằng một read_group; kho tồn chung chỉ giữ các kho cấu hình
+    domain = [('product_id', '=', product_id), ('location_id.usage', 'in', DETAIL_LOCATION_USAGES)]
+    rows = None
+    if QUANT_READ_GROUP:
+        try:
+            groups = models.execute_kw(
+                ODOO_DB, uid, ODOO_PASSWORD,
+                'stock.quant', 'read_group',
+                [domain, ['quantity:sum', 'reserved_quantity:sum'], ['location_id']],
+                {'lazy': False}
+            )
+            rows = [
+                (g['location_id'][0], (g.get('quantity') or 0.0) - (g.get('reserved_quantity') or 0.0))
+                for g in groups if g.get('location_id')
+            ]
+        except xmlrpc.client.Fault as e:
+            if _is_session_error(e):
+                raise
+            logger.warning(f"read_group tồn chi tiết lỗi, đọc quant thô: {e}")
+    if rows is None:
+        quants = models.execute_kw(
+            ODOO_DB, uid, ODOO_PASSWORD,
+            'stock.quant', 'search_read',
+            [domain],
+            {'fields': ['location_id', 'available_quantity']}
+        )
+        rows = [
+            (q['location_id'][0], float(q.get('available_quantity') or 0.0))
+            for q in quants if q.get('location_id')
+        ]
+
+    details = {}
+    for loc_id, qty in rows:
+        details[loc_id] = details.get(loc_id, 0.0) + qty
+    return {loc_id: qty for loc_id, qty in details.items() if qty > 0}
+
+
+def _inventory_columns(product_ids, key_codes, on_hand, available):
+    keep = (product_ids > 0) & (key_codes >= 0)
+    if not keep.all():
+        product_ids, key_codes = product_ids[keep], key_codes[keep]
+        on_hand, available = on_hand[keep], available[keep]
+    return pd.DataFrame({
+        'product_id': product_ids,
+        'key': pd.Categorical.from_codes(key_codes, categories=STOCK_LOCATIONS.keys),
+        'on_hand': on_hand,
+        'available': available,
+    }, copy=False)
+
+
+def quants_to_frame(quant_data, tree):
+    # Payload stock.quant -> bảng cột (product_id, key, on_hand, available), mỗi quant một dòng.
+    # Các dòng trùng (SP, kho) được cộng ở bước tính.
+    n = len(quant_data)
+    code_of = {k: i for i, k in enumerate(STOCK_LOCATIONS.keys)}
+    loc_code = {loc_id: code_of[k] for loc_id, k in tree.items() if k in code_of}
+
+    product_ids = np.fromiter(
+        (q['product_id'][0] if q.get('product_id') else 0 for q in quant_data), np.int64, n
+    )
+    key_codes = np.fromiter(
+        (loc_code.get(q['location_id'][0], -1) if q.get('location_id') else -1 for q in quant_data),
+        np.int8, n
+    )
+    on_hand = np.fromiter((q.get('quantity') or 0.0 for q in quant_data), np.float64, n)
+    available = np.fromiter(
+        (
+            q['available_quantity'] if q.get('available_quantity') is not None
+            else (q.get('quantity') or 0.0) - (q.get('reserved_quantity') or 0.0)
+            for q in quant_data
+        ),
+        np.float64, n
+    )
+    return _inventory_columns(product_ids, key_codes, on_hand, available)
+
+
+def load_inventory_frame(models, uid, product_ids=None):
+    # Như load_inventory nhưng trả thẳng bảng cột; mỗi lô quant được đổi sang
+    # cột numpy ngay rồi bỏ, nên chỉ 1 lô dict nằm trong RAM tại một thời điểm
+    batches, tree = _iter_inventory_quants(models, uid, product_ids)
+    frames = [quants_to_frame(quant_data, tree) for quant_data in batches]
+    if not frames:
+        return quants_to_frame([], tree)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, copy=False)
+
+
+def inventory_frame(matrix):
+    # Ma trận của InventoryStore -> bảng cột như quants_to_frame
+    n = sum(len(cells) for cells in matrix.values())
+    code_of = {k: i for i, k in enumerate(STOCK_LOCATIONS.keys)}
+
+    def column(get, dtype):
+        return np.fromiter(
+            (get(pid, key, cell) for pid, cells in matrix.items() for key, cell in cells.items()),
+            dtype, n
+        )
+
+    return _inventory_columns(
+        column(lambda pid, key, cell: pid, np.int64),
+        column(lambda pid, key, cell: code_of.get(key, -1), np.int8),
+        column(lambda pid, key, cell: cell[0], np.float64),
+        column(lambda pid, key, cell: cell[1], np.float64),
     )
 
-    total = 0
-    for q in quant_data:
-        total += int(q.get('quantity') or 0)
-    return total
+
+def stock_levels(cells, measure='on_hand'):
+    return STOCK_LOCATIONS.levels(cells, measure)
+
+
+class InventorySnapshot:
+    def __init__(self, matrix, version, refreshed_at):
+        self.matrix = matrix
+        self.version = version
+        self.refreshed_at = refreshed_at
+
+    def get(self, product_id):
+        return self.matrix.get(product_id, {})
+
+
+# Kho tồn dùng chung cho tra mã, /keohang và /checkpo; làm mới nền mỗi INVENTORY_REFRESH giây.
+# version chỉ tăng khi số liệu thực sự thay đổi.
+class InventoryStore:
+    def __init__(self, interval=INVENTORY_REFRESH):
+        self.interval = interval
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def refresh(self, models=None, uid=None):
+        with self._refresh_lock:
+            if models is None:
+                uid, models, err = connect_odoo()
+                if not uid:
+                    raise OdooSessionError(err)
+
+            matrix = load_inventory(models, uid)
+            with self._lock:
+                old = self._snapshot
+                if old is not None and old.matrix == matrix:
+                    version = old.version
+                else:
+                    version = (old.version if old else 0) + 1
+                self._snapshot = InventorySnapshot(matrix, version, time.time())
+                return self._snapshot
+
+    def snapshot(self, models=None, uid=None):
+        with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+        return self.refresh(models, uid)
+
+    def peek(self):
+        # Snapshot hiện có, không nạp mới
+        with self._lock:
+            return self._snapshot
+
+    def request_refresh(self):
+        self._wakeup.set()
+
+    def run(self):
+        CURRENT_COMMAND.set('inventory')
+        while True:
+            try:
+                snap = self.refresh()
+                logger.info(f"Đã làm mới tồn kho: {len(snap.matrix)} SP, version {snap.version}")
+            except Exception as e:
+                logger.warning(f"Lỗi làm mới tồn kho: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+
+INVENTORY = InventoryStore()
+SERVICES.register('inventory', lambda: INVENTORY.run())
+
+
+# ---------------- Product catalog ----------------
+CATALOG_REFRESH = int(os.environ.get('CATALOG_REFRESH', '300'))
+CATALOG_PAGE_SIZE = int(os.environ.get('CATALOG_PAGE_SIZE', '5000'))
+CATALOG_FULL_RESYNC = int(os.environ.get('CATALOG_FULL_RESYNC', '3600'))  # giây giữa 2 lần đọc toàn bộ
+CATALOG_FIELDS = ['id', 'display_name', PRODUCT_CODE_FIELD, 'active', 'write_date']
+
+
+def normalize_code(code):
+    return str(code or "").strip().upper()
+
+
+# Chỉ mục mã SP -> {id, display_name, default_code} nạp hàng loạt theo trang id,
+# sau đó chỉ làm mới các SP (hoặc mẫu SP) có write_date mới; mỗi CATALOG_FULL_RESYNC
+# giây đọc lại toàn bộ để bỏ SP đã xoá hẳn. Tra đúng mã không cần RPC.
+class ProductCatalog:
+    def __init__(self, interval=CATALOG_REFRESH, page_size=CATALOG_PAGE_SIZE,
+                 full_resync=CATALOG_FULL_RESYNC):
+        self.interval = interval
+        self.page_size = page_size
+        self.full_resync = full_resync
+
+        self._by_id = {}
+        self._by_code = {}
+        self._codes = []
+        self._cursor = None
+        self._loaded = False
+        self._last_full = 0.0
+        # Tăng mỗi khi tên / mã SP thay đổi (dùng làm khoá cache báo cáo)
+        self.version = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _fetch(self, models, uid, domain):
+        records = []
+        last_id = 0
+        while True:
+            page = models.execute_kw(
+                ODOO_DB, uid, ODOO_PASSWORD,
+                'product.product', 'search_read',
+                [domain + [('id', '>', last_id)]],
+                {'fields': CATALOG_FIELDS, 'order': 'id', 'limit': self.page_size,
+                 'context': {'active_test': False}}
+            )
+            records.extend(page)
+            if len(page) < self.page_size:
+                return records
+            last_id = page[-1]['id']
+
+    def _apply(self, records):
+        changed = False
+        for p in records:
+            old = self._by_id.pop(p['id'], None)
+            if old:
+                old_code = normalize_code(old.get(PRODUCT_CODE_FIELD))
+                if self._by_code.get(old_code) is old:
+                    del self._by_code[old_code]
+
+            if p.get('active') is False:
+                changed = changed or old is not None
+                continue
+
+            entry = {
+                'id': p['id'],
+                'display_name': p.get('display_name') or '',
+                PRODUCT_CODE_FIELD: p.get(PRODUCT_CODE_FIELD) or False,
+            }
+            self._by_id[p['id']] = entry
+            changed = changed or old != entry
+
+            code = normalize_code(entry[PRODUCT_CODE_FIELD])
+            if code and (code not in self._by_code or self._by_code[code]['id'] > p['id']):
+                self._by_code[code] = entry
+
+        self._codes = sorted(self._by_code)
+        return changed
+
+    def refresh(self, models=None, uid=None, full=False):
+        with self._refresh_lock:
+            if models is None:
+                uid, models, err = connect_odoo()
+                if not uid:
+                    raise OdooSessionError(err)
+
+            full = full or not self._loaded
+            if full or not self._cursor:
+                domain = []
+            else:
+                # Đổi tên mẫu SP làm đổi display_name mà không đổi write_date của biến thể
+                since = write_date_since(self._cursor)
+                domain = ['|', ('write_date', '>=', since),
+                          ('product_tmpl_id.write_date', '>=', since)]
+            records = self._fetch(models, uid, domain)
+
+            with self._lock:
+                before = self._by_id
+                if full:
+                    self._by_id = {}
+                    self._by_code = {}
+                changed = self._apply(records)
+                if full:
+                    changed = self._by_id != before
+                if changed:
+                    self.version += 1
+                cursor = self._cursor
+                dates = [p['write_date'] for p in records if p.get('write_date')]
+                if dates:
+                    self._cursor = max(dates + ([self._cursor] if self._cursor and not full else []))
+                self._loaded = True
+                if full:
+                    self._last_full = time.time()
+                if changed or self._cursor != cursor:
+                    STATE.put(state_key('catalog'), {
+                        'code_field': PRODUCT_CODE_FIELD,
+                        'cursor': self._cursor,
+                        'products': list(self._by_id.values()),
+                    })
+            return len(records)
+
+    def restore(self, data):
+        # Danh mục đã lưu: tra mã được ngay khi khởi động; _last_full = 0 nên run()
+        # đọc lại toàn bộ ở nền ngay vòng đầu (bản lưu có thể thiếu SP đã bị xoá hẳn)
+        if not data or data.get('code_field') != PRODUCT_CODE_FIELD:
+            return 0
+        with self._lock:
+            self._by_id = {}
+            self._by_code = {}
+            self._apply(data['products'])
+            self._cursor = data['cursor']
+            self._loaded = True
+            self._last_full = 0.0
+            self.version += 1
+        return len(self._by_id)
+
+    def ensure_loaded(self, models=None, uid=None):
+        if not self._loaded:
+            self.refresh(models, uid)
+
+    def get(self, code):
+        with self._lock:
+            return self._by_code.get(normalize_code(code))
+
+    def get_by_id(self, product_id):
+        with self._lock:
+            return self._by_id.get(product_id)
+
+    def lookup(self, code, models=None, uid=None):
+        self.ensure_loaded(models, uid)
+        product = self.get(code)
+        if product is None:
+            # SP vừa tạo sau lần làm mới trước: làm mới tăng dần 1 lần rồi tra lại
+            self.refresh(models, uid)
+            product = self.get(code)
+        return product
+
+    def lookup_many(self, codes, models=None, uid=None):
+        self.ensure_loaded(models, uid)
+        codes = [normalize_code(c) for c in codes]
+        with self._lock:
+            found = {c: self._by_code[c] for c in codes if c in self._by_code}
+        if len(found) < len(set(codes)):
+            self.refresh(models, uid)
+            with self._lock:
+                found = {c: self._by_code[c] for c in codes if c in self._by_code}
+        return found
+
+    def suggest(self, code, limit=5):
+        code = normalize_code(code)
+        if not code:
+            return []
+
+        with self._lock:
+            codes = self._codes
+            start = bisect.bisect_left(codes, code)
+            out = []
+            for c in codes[start:start + limit]:
+                if not c.startswith(code):
+                    break
+                out.append(c)
+
+            if len(out) < limit:
+                near = [c for c in codes if abs(len(c) - len(code)) <= 2]
+                for c in difflib.get_close_matches(code, near, n=limit, cutoff=0.75):
+                    if c not in out:
+                        out.append(c)
+            return out[:limit]
+
+    def run(self):
+        CURRENT_COMMAND.set('catalog')
+        while True:
+            try:
+                n = self.refresh(full=time.time() - self._last_full >= self.full_resync)
+                logger.info(f"Đã làm mới danh mục SP: {n} bản ghi, tổng {len(self._by_code)} mã")
+            except Exception as e:
+                logger.warning(f"Lỗi làm mới danh mục SP: {e}")
+            time.sleep(self.interval)
+
+
+PRODUCT_CATALOG = ProductCatalog()
+SERVICES.register('catalog', lambda: PRODUCT_CATALOG.run())
+
 
 def escape_markdown(text):
     chars = ['\\','_','*','[',']','(',')','~','`','>','#','+','-','=','|','{','}','.','!']
@@ -161,6 +1498,124 @@ def escape_markdown(text):
         text = text.replace(c, f"\\{c}")
     return text.replace('\\`', '`')
 
+# ---------------- State store (SQLite) ----------------
+# Trạng thái giữ qua các lần khởi động lại: chat đã đăng ký, baseline watchdog,
+# danh mục SP, danh sách kho. STATE_DB rỗng = không lưu gì.
+STATE_DB = os.environ.get('STATE_DB', 'bot_state.db').strip()
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '5'))
+# Dữ liệu lấy từ Odoo được khoá theo server + DB, đổi DB thì không nạp nhầm cache cũ
+STATE_SCOPE = f"{ODOO_URL_FINAL}/{ODOO_DB}"
+
+METRICS.describe('state_store_writes_total', 'counter', "Số key ghi xuống SQLite")
+METRICS.describe('state_store_flush_duration_seconds', 'histogram',
+                 "Thời gian một lần ghi lô xuống SQLite", LATENCY_BUCKETS)
+METRICS.describe('bot_startup_seconds', 'gauge',
+                 "Thời gian khởi động: restore = nạp lại trạng thái, ready = tới lúc nhận tin")
+
+
+def state_key(name):
+    return f"{STATE_SCOPE}:{name}"
+
+
+# Bảng key -> JSON trong SQLite (WAL). put() chỉ giữ giá trị mới nhất trong bộ nhớ;
+# luồng nền ghi mọi key đã đổi trong 1 transaction mỗi STATE_FLUSH_INTERVAL giây
+# và khi thoát. Giá trị đưa vào put() không được sửa tại chỗ sau đó.
+class StateStore:
+    def __init__(self, path=STATE_DB, flush_interval=STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+        try:
+            with self._db_lock:
+                row = self._connect().execute(
+                    "SELECT value FROM state WHERE key = ?", (key,)
+                ).fetchone()
+            return json.loads(row[0]) if row else default
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"Lỗi đọc trạng thái {key}: {e}")
+            return default
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending[key] = value
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        started = time.perf_counter()
+        now = time.time()
+        try:
+            rows = [
+                (key, json.dumps(value, ensure_ascii=False, separators=(',', ':')), now)
+                for key, value in pending.items()
+            ]
+            with self._db_lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO state (key, value, updated_at) VALUES (?, ?, ?)", rows
+                    )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            # Giữ lại để thử ở lần sau, trừ key đã có giá trị mới hơn
+            logger.warning(f"Lỗi ghi trạng thái: {e}")
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending.setdefault(key, value)
+            return 0
+
+        METRICS.inc('state_store_writes_total', len(rows))
+        METRICS.observe('state_store_flush_duration_seconds', time.perf_counter() - started)
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def run(self):
+        CURRENT_COMMAND.set('state')
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+STATE = StateStore()
+SERVICES.register('state', lambda: STATE.run())
+
+
 # ---------------- Chat ID Registry ----------------
 REGISTERED_CHAT_IDS = set()
 CHAT_IDS_LOCK = threading.Lock()
@@ -174,167 +1629,336 @@ def register_chat_id(chat_id):
         cid = chat_id
 
     with CHAT_IDS_LOCK:
+        if cid in REGISTERED_CHAT_IDS:
+            return
         REGISTERED_CHAT_IDS.add(cid)
+        STATE.put('chats', sorted(REGISTERED_CHAT_IDS, key=str))
 
 def get_registered_chat_ids():
     with CHAT_IDS_LOCK:
         return list(REGISTERED_CHAT_IDS)
 
+def restore_chat_ids():
+    chats = STATE.get('chats') or []
+    with CHAT_IDS_LOCK:
+        REGISTERED_CHAT_IDS.update(chats)
+    return len(chats)
+
+# ---------------- Report writer ----------------
+REPORT_SPOOL_BYTES = int(os.environ.get('REPORT_SPOOL_BYTES', str(8 * 1024 * 1024)))
+REPORT_GZIP_LEVEL = int(os.environ.get('REPORT_GZIP_LEVEL', '6'))
+
+REPORT_FORMATS = {
+    'xlsx': 'xlsx',
+    'excel': 'xlsx',
+    'csv': 'csv',
+    'gz': 'csv.gz',
+    'csv.gz': 'csv.gz',
+    'csvgz': 'csv.gz',
+}
+
+
+def report_format(args):
+    # /keohang csv, /checkpo csv.gz ...
+    for a in args or []:
+        fmt = REPORT_FORMATS.get(str(a).strip().lower())
+        if fmt:
+            return fmt
+    return 'xlsx'
+
+
+def report_filename(base, fmt):
+    return f"{base}.{fmt}"
+
+
+def _clean_cell(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Ghi báo cáo từng dòng ngay khi tính xong: xlsx dùng openpyxl write-only,
+# csv / csv.gz ghi thẳng. Kết quả nằm trong SpooledTemporaryFile nên file lớn
+# được đẩy xuống đĩa thay vì giữ trong RAM.
+class ReportWriter:
+    def __init__(self, sheet_name, columns, fmt='xlsx'):
+        self.fmt = fmt
+        self.rows = 0
+        self._out = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES)
+        self._gzip = None
+
+        if fmt == 'xlsx':
+            self._wb = openpyxl.Workbook(write_only=True)
+            self._ws = self._wb.create_sheet(sheet_name)
+            header = []
+            for col in columns:
+                cell = openpyxl.cell.WriteOnlyCell(self._ws, value=col)
+                cell.font = openpyxl.styles.Font(bold=True)
+                header.append(cell)
+            self._ws.append(header)
+        else:
+            raw = self._out
+            if fmt == 'csv.gz':
+                self._gzip = raw = gzip.GzipFile(
+                    fileobj=self._out, mode='wb', compresslevel=REPORT_GZIP_LEVEL
+                )
+            # utf-8-sig để Excel mở đúng tiếng Việt
+            self._text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(columns)
+
+    def write_row(self, row):
+        row = [_clean_cell(v) for v in row]
+        if self.fmt == 'xlsx':
+            self._ws.append(row)
+        else:
+            self._csv.writerow(['' if v is None else v for v in row])
+        self.rows += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        if self.fmt == 'xlsx':
+            self._wb.save(self._out)
+        else:
+            self._text.flush()
+            self._text.detach()
+            if self._gzip is not None:
+                self._gzip.close()
+        self._out.seek(0)
+        return self._out
+
+
 # ---------------- Report /keohang ----------------
-def get_stock_data():
+KEOHANG_COLUMNS = (
+    ['Mã SP', 'Tên SP'] + [l.name for l in STOCK_LOCATIONS] + ['Số Lượng Đề Xuất']
+)
+
+
+def compute_keohang(stock):
+    # stock: bảng cột (product_id, key, on_hand, available).
+    # Trả về các SP cần kéo (index = product_id, theo thứ tự xuất hiện; một cột mỗi kho
+    # theo key + 'de_xuat') hoặc None nếu không có tồn.
+    if stock.empty:
+        return None
+
+    # id SP của Odoo liên tục nên cộng bằng bincount theo id; nếu id quá thưa thì nén lại trước
+    pid = stock['product_id'].to_numpy()
+    uniq = None
+    size = int(pid.max()) + 1
+    if size > 4 * len(pid) + 100_000:
+        uniq, pid = np.unique(pid, return_inverse=True)
+        size = len(uniq)
+
+    # Mỗi kho lấy số theo measure cấu hình (CÓ HÀNG hoặc HIỆN CÓ)
+    codes = stock['key'].cat.codes.to_numpy()
+    levels = {}
+    for i, loc in enumerate(STOCK_LOCATIONS):
+        mask = codes == i
+        values = stock[loc.measure].to_numpy()
+        levels[loc.key] = np.bincount(pid[mask], weights=values[mask], minlength=size).clip(min=0)
+    if not any((v > 0).any() for v in levels.values()):
+        return None
+
+    levels = {key: np.round(v).astype(np.int64) for key, v in levels.items()}
+    zero = np.zeros(size, dtype=np.int64)
+    local_total = sum((levels[l.key] for l in STOCK_LOCATIONS.local), zero)
+    source_total = sum((levels[l.key] for l in STOCK_LOCATIONS.sources), zero)
+
+    de_xuat = np.minimum(TARGET_MIN_QTY - local_total, source_total)
+    ids = np.flatnonzero((local_total < TARGET_MIN_QTY) & (de_xuat > 0))
+
+    # Giữ thứ tự SP như lần xuất hiện đầu tiên trong dữ liệu tồn
+    first = np.full(size, len(pid), dtype=np.int64)
+    np.minimum.at(first, pid, np.arange(len(pid)))
+    ids = ids[np.argsort(first[ids], kind='stable')]
+
+    columns = {key: v[ids] for key, v in levels.items()}
+    columns['de_xuat'] = de_xuat[ids]
+    return pd.DataFrame(
+        columns, index=pd.Index(uniq[ids] if uniq is not None else ids, name='product_id'),
+    )
+
+
+def get_stock_data(fresh=False, fmt='xlsx'):
     uid, models, error_msg = connect_odoo()
     if not uid:
         return None, 0, error_msg
 
     try:
         location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
-        if len(location_ids) < 3:
-            error_msg = f"không tìm thấy đủ 3 kho cần thiết: {list(location_ids.keys())}"
+        if len(location_ids) < len(STOCK_LOCATIONS):
+            error_msg = (
+                f"không tìm thấy đủ {len(STOCK_LOCATIONS)} kho cần thiết: {list(location_ids.keys())}"
+            )
             logger.error(error_msg)
             return None, 0, error_msg
 
-        hn_id   = location_ids.get('HN_STOCK', {}).get('id')
-        hcm_id  = location_ids.get('HCM_STOCK', {}).get('id')
-        tran_id = location_ids.get('HN_TRANSIT', {}).get('id')
+        if fresh:
+            stock = load_inventory_frame(models, uid)
+        else:
+            stock = inventory_frame(INVENTORY.snapshot(models, uid).matrix)
+
+        suggest = compute_keohang(stock)
+        if suggest is None:
+            writer = ReportWriter('DeXuatKeoHang', KEOHANG_COLUMNS, fmt)
+            return writer.close(), 0, "không có SP nào cần kéo"
+
+        # Lấy tên SP (chỉ các SP cần kéo), ưu tiên danh mục đã cache
+        product_map = {}
+        missing = suggest.index.tolist()
+        if not fresh:
+            PRODUCT_CATALOG.ensure_loaded(models, uid)
+            for pid in missing:
+                p = PRODUCT_CATALOG.get_by_id(pid)
+                if p:
+                    product_map[pid] = p
+            missing = [pid for pid in missing if pid not in product_map]
+
+        if missing:
+            product_info = models.execute_kw(
+                ODOO_DB, uid, ODOO_PASSWORD,
+                'product.product', 'search_read',
+                [[('id', 'in', missing)]],
+                {'fields': ['display_name', PRODUCT_CODE_FIELD]}
+            )
+            product_map.update({p['id']: p for p in product_info})
 
-        quant_data_raw = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'stock.quant', 'search_read',
-            [[('location_id', 'in', [hn_id, hcm_id, tran_id])]],
-            {'fields': ['product_id', 'location_id', 'quantity',
-                        'reserved_quantity', 'available_quantity']}
-        )
+        # Build báo cáo kéo hàng
+        writer = ReportWriter('DeXuatKeoHang', KEOHANG_COLUMNS, fmt)
+        for pid, *values in zip(
+            suggest.index.tolist(),
+            *(suggest[key].tolist() for key in STOCK_LOCATIONS.keys + ['de_xuat']),
+        ):
+            prod = product_map.get(pid)
+            if not prod:
+                continue
+            writer.write_row([prod.get(PRODUCT_CODE_FIELD, ''), prod.get('display_name', '')] + values)
 
-        stock_map = {}
+        return writer.close(), writer.rows, "thành công"
 
-        for q in quant_data_raw:
-            pid = q['product_id'][0]
-            loc = q['location_id'][0]
+    except Exception as e:
+        logger.error(f"lỗi khi xử lý kéo hàng: {e}")
+        return None, 0, f"lỗi khi xử lý kéo hàng: {e}"
 
-            # HN & HCM: CÓ HÀNG (available_quantity)
-            # Kho Nhập HN: HIỆN CÓ (quantity)
-            if loc == tran_id:
-                real_qty = float(q.get('quantity', 0))
-            else:
-                if 'available_quantity' in q and q.get('available_quantity') is not None:
-                    real_qty = float(q.get('available_quantity', 0))
-                else:
-                    real_qty = float(q.get('quantity', 0)) - float(q.get('reserved_quantity', 0))
 
-            if real_qty <= 0:
-                continue
+# ---------------- PO /checkpo helpers ----------------
+PO_MAX_FILE_BYTES = int(os.environ.get('PO_MAX_FILE_BYTES', str(10 * 1024 * 1024)))
+PO_MAX_ROWS = int(os.environ.get('PO_MAX_ROWS', '20000'))
+PO_HEADER_SCAN_ROWS = int(os.environ.get('PO_HEADER_SCAN_ROWS', '30'))
 
-            if pid not in stock_map:
-                stock_map[pid] = {'hn': 0, 'tran': 0, 'hcm': 0}
-
-            if loc == hn_id:
-                stock_map[pid]['hn'] += real_qty
-            elif loc == tran_id:
-                stock_map[pid]['tran'] += real_qty
-            elif loc == hcm_id:
-                stock_map[pid]['hcm'] += real_qty
-
-        if not stock_map:
-            df_empty = pd.DataFrame(columns=[
-                'Mã SP', 'Tên SP', 'Tồn Kho HN',
-                'Tồn Kho HCM', 'Kho Nhập HN', 'Số Lượng Đề Xuất'
-            ])
-            buf = io.BytesIO()
-            df_empty.to_excel(buf, index=False, sheet_name='DeXuatKeoHang')
-            buf.seek(0)
-            return buf, 0, "không có SP nào cần kéo"
-
-        # Lấy tên SP
-        pids = list(stock_map.keys())
-        product_info = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'product.product', 'search_read',
-            [[('id', 'in', pids)]],
-            {'fields': ['display_name', PRODUCT_CODE_FIELD]}
-        )
-        product_map = {p['id']: p for p in product_info}
+PO_HEADER_KEYS = [
+    "model", "mã sp", "ma sp", "mã hàng", "ma hang",
+    "mã sản phẩm", "ma san pham"
+]
 
-        # Build báo cáo kéo hàng
-        report = []
-        for pid, qtys in stock_map.items():
-            prod = product_map.get(pid)
-            if not prod:
-                continue
 
-            code = prod.get(PRODUCT_CODE_FIELD, '')
-            name = prod.get('display_name', '')
-
-            ton_hn   = int(round(qtys['hn']))
-            ton_tran = int(round(qtys['tran']))
-            ton_hcm  = int(round(qtys['hcm']))
-
-            tong_hn = ton_hn + ton_tran
-
-            if tong_hn < TARGET_MIN_QTY:
-                need = TARGET_MIN_QTY - tong_hn
-                de_xuat = min(need, ton_hcm)
-                if de_xuat > 0:
-                    report.append({
-                        'Mã SP': code,
-                        'Tên SP': name,
-                        'Tồn Kho HN': ton_hn,
-                        'Tồn Kho HCM': ton_hcm,
-                        'Kho Nhập HN': ton_tran,
-                        'Số Lượng Đề Xuất': de_xuat
-                    })
+def _po_cell(value):
+    # Giống pandas: số thực nguyên (12345.0) đọc thành int
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
 
-        df = pd.DataFrame(report)
-        cols = [
-            'Mã SP', 'Tên SP', 'Tồn Kho HN',
-            'Tồn Kho HCM', 'Kho Nhập HN', 'Số Lượng Đề Xuất'
-        ]
 
-        if not df.empty:
-            df = df[cols]
+def _po_header_names(row):
+    # Tên cột giống pandas: ô trống -> "Unnamed: i", trùng tên -> "X.1"
+    names = []
+    seen = {}
+    for i, value in enumerate(row):
+        name = str(_po_cell(value)) if value is not None else f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
         else:
-            df = pd.DataFrame(columns=cols)
+            seen[name] = 0
+        names.append(name)
+    return names
 
-        buf = io.BytesIO()
-        df.to_excel(buf, index=False, sheet_name="DeXuatKeoHang")
-        buf.seek(0)
 
-        return buf, len(df), "thành công"
+def _read_po_with_auto_header(source):
+    # Đọc PO 1 lượt bằng openpyxl read-only: tìm header trong PO_HEADER_SCAN_ROWS
+    # dòng đầu, sau đó chỉ giữ 3 cột Model / Số lượng / ĐV nhận.
+    # Trả về (DataFrame['Mã SP', 'SL cần giao', 'ĐV nhận'], error_msg)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
 
-    except Exception as e:
-        logger.error(f"lỗi khi xử lý kéo hàng: {e}")
-        return None, 0, f"lỗi khi xử lý kéo hàng: {e}"
+    source.seek(0, io.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    if size > PO_MAX_FILE_BYTES:
+        return None, f"File PO quá lớn ({size // 1024} KB, tối đa {PO_MAX_FILE_BYTES // 1024} KB)."
 
-
-# ---------------- PO /checkpo helpers ----------------
-def _read_po_with_auto_header(file_bytes: bytes):
     try:
-        df_tmp = pd.read_excel(io.BytesIO(file_bytes), header=None)
+        wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
     except Exception as e:
         return None, f"Không đọc được file Excel PO: {e}"
 
-    header_row_idx = None
-    for idx in range(len(df_tmp)):
-        row_values = df_tmp.iloc[idx].astype(str).str.lower()
-        row_text = " ".join(row_values)
-        if any(key in row_text for key in [
-            "model", "mã sp", "ma sp", "mã hàng", "ma hang",
-            "mã sản phẩm", "ma san pham"
-        ]):
-            header_row_idx = idx
-            break
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+
+        # Tìm header trong các dòng đầu; không thấy thì lấy dòng đầu tiên
+        scanned = []
+        header = None
+        for row in rows:
+            scanned.append(row)
+            row_text = " ".join(str(v) for v in row if v is not None).lower()
+            if any(key in row_text for key in PO_HEADER_KEYS):
+                header = row
+                break
+            if len(scanned) >= PO_HEADER_SCAN_ROWS:
+                break
 
-    if header_row_idx is None:
-        header_row_idx = 0
+        if header is None:
+            if not scanned:
+                return None, "File PO không có dữ liệu."
+            header = scanned[0]
+            pending = scanned[1:]
+        else:
+            pending = []
+
+        columns = _po_header_names(header)
+        code_col, qty_col, recv_col = _detect_po_columns(columns)
+        if not code_col or not qty_col or not recv_col:
+            return None, (
+                "Không xác định được Model – Số lượng – ĐV nhận.\n"
+                f"Các cột hiện có: {columns}"
+            )
+        picks = [columns.index(code_col), columns.index(qty_col), columns.index(recv_col)]
 
-    try:
-        df_raw = pd.read_excel(io.BytesIO(file_bytes), header=header_row_idx)
-        return df_raw, None
+        codes, qtys, receivers = [], [], []
+        for source_rows in (pending, rows):
+            for row in source_rows:
+                values = [_po_cell(row[i]) if i < len(row) else None for i in picks]
+                if all(v is None for v in values):
+                    continue
+                if len(codes) >= PO_MAX_ROWS:
+                    return None, f"File PO quá nhiều dòng (tối đa {PO_MAX_ROWS} dòng)."
+                codes.append(values[0])
+                qtys.append(values[1])
+                receivers.append(values[2])
     except Exception as e:
-        return None, f"Không đọc được file Excel PO với header tại dòng {header_row_idx + 1}: {e}"
+        return None, f"Không đọc được file Excel PO: {e}"
+    finally:
+        wb.close()
 
+    df = pd.DataFrame({
+        'Mã SP': pd.Series(codes, dtype=object),
+        'SL cần giao': pd.Series(qtys, dtype=object),
+        'ĐV nhận': pd.Series(receivers, dtype=object),
+    })
+    return df, None
 
-def _detect_po_columns(df: pd.DataFrame):
-    cols_lower = {col: str(col).strip().lower() for col in df.columns}
+
+def _detect_po_columns(columns):
+    cols_lower = {col: str(col).strip().lower() for col in columns}
 
     code_col = None
     for col, lower in cols_lower.items():
@@ -374,55 +1998,127 @@ def _detect_po_columns(df: pd.DataFrame):
     return code_col, qty_col, recv_col
 
 
-def _get_stock_for_product_with_cache(models, uid, product_id, location_ids, cache):
-    if product_id in cache:
-        return cache[product_id]
+# Cột tồn / phân bổ sinh theo tập kho: kho local, tổng local, kho nguồn
+KIEMTRAPO_COLUMNS = (
+    ['Mã SP', 'Tên SP', 'ĐV nhận', 'SL cần giao']
+    + [f"Tồn {l.label}" for l in STOCK_LOCATIONS.local]
+    + [f"Tổng tồn {LOCAL_GROUP_LABEL}"]
+    + [f"Tồn {l.label}" for l in STOCK_LOCATIONS.sources]
+    + ['Trạng thái']
+    + [f"SL phân bổ {l.label}" for l in STOCK_LOCATIONS.local]
+    + [f"SL cần kéo từ {l.label}" for l in STOCK_LOCATIONS.sources]
+    + ['SL thiếu']
+)
 
-    hn_id      = location_ids.get('HN_STOCK', {}).get('id')
-    transit_id = location_ids.get('HN_TRANSIT', {}).get('id')
-    hcm_id     = location_ids.get('HCM_STOCK', {}).get('id')
+# allocate: tồn được trừ dần qua các dòng cùng SP trong PO
+# independent: mỗi dòng so với toàn bộ tồn (cách cũ)
+PO_ALLOCATION_MODE = os.environ.get('PO_ALLOCATION_MODE', 'allocate').strip().lower()
+# ĐV nhận được ưu tiên phân bổ trước, theo thứ tự, vd: "CH1,CH3"; còn lại theo thứ tự dòng PO
+PO_RECEIVER_PRIORITY = [
+    r.strip().lower() for r in os.environ.get('PO_RECEIVER_PRIORITY', '').split(',') if r.strip()
+]
 
-    def _get_qty(location_id):
-        if not location_id:
-            return 0
-        stock_product_info = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'product.product', 'read',
-            [[product_id]],
-            {'fields': ['qty_available'], 'context': {'location': location_id}}
-        )
-        if stock_product_info and stock_product_info[0]:
-            return int(round(stock_product_info[0].get('qty_available', 0.0)))
-        return 0
 
-    result = {
-        'hn': _get_qty(hn_id),
-        'transit': _get_qty(transit_id),
-        'hcm': _get_qty(hcm_id),
-    }
-    cache[product_id] = result
-    return result
+PO_STATUS_SHORT = "THIẾU DÙ ĐÃ KÉO TỐI ĐA"
+PO_STATUS_NOT_FOUND = "KHÔNG TÌM THẤY MÃ"
 
 
-def process_po_and_build_report(file_bytes: bytes):
-    df_raw, err = _read_po_with_auto_header(file_bytes)
-    if df_raw is None:
-        return None, err
+def _allocation_demand_before(pids, need, receivers, priority):
+    # Tổng SL của các dòng cùng SP được phân bổ trước dòng hiện tại
+    rank = np.full(len(pids), len(priority), dtype=np.int64)
+    if priority:
+        order_of = {r: i for i, r in enumerate(priority)}
+        keys = receivers.map(lambda v: '' if v is None or v != v else str(v).strip().lower())
+        rank = keys.map(order_of).fillna(len(priority)).to_numpy(dtype=np.int64)
 
-    if df_raw.empty:
-        return None, "File PO không có dữ liệu."
+    order = np.lexsort((np.arange(len(pids)), rank))
+    ordered = pd.Series(need[order], index=order)
+    cum = ordered.groupby(pids[order], sort=False).cumsum()
+    before = np.empty(len(pids), dtype=np.int64)
+    before[order] = cum.to_numpy() - need[order]
+    return before
 
-    code_col, qty_col, recv_col = _detect_po_columns(df_raw)
-    if not code_col or not qty_col or not recv_col:
-        return None, (
-            "Không xác định được Model – Số lượng – ĐV nhận.\n"
-            f"Các cột hiện có: {list(df_raw.columns)}"
-        )
 
-    df = df_raw[[code_col, qty_col, recv_col]].copy()
-    df.columns = ['Mã SP', 'SL cần giao', 'ĐV nhận']
+def evaluate_po(df, code_map, stock_map, mode=None, priority=None):
+    # df: 'Mã SP' (đã chuẩn hoá), 'SL cần giao', 'ĐV nhận'
+    # code_map: code -> {'id', 'display_name'}; stock_map: pid -> {location key: SL}
+    # Trả về DataFrame đúng thứ tự cột KIEMTRAPO_COLUMNS, giữ thứ tự dòng PO
+    mode = mode or PO_ALLOCATION_MODE
+    priority = PO_RECEIVER_PRIORITY if priority is None else priority
+    # Thứ tự lấy hàng: các kho local rồi các kho nguồn
+    order = STOCK_LOCATIONS.local + STOCK_LOCATIONS.sources
+    keys = [l.key for l in order]
+
+    products = pd.DataFrame(
+        [(code, p['id'], p['display_name']) for code, p in code_map.items()],
+        columns=['Mã SP', 'pid', 'Tên SP'],
+    )
+    stock = pd.DataFrame(
+        [[levels.get(k, 0) for k in keys] for levels in stock_map.values()],
+        index=pd.Index(list(stock_map), name='pid', dtype=np.int64), columns=keys,
+    )
+
+    out = (
+        df[['Mã SP', 'SL cần giao', 'ĐV nhận']]
+        .reset_index(drop=True)
+        .merge(products, on='Mã SP', how='left', sort=False)
+        .merge(stock, left_on='pid', right_index=True, how='left', sort=False)
+    )
+
+    found = out['pid'].notna().to_numpy()
+    need = np.rint(out['SL cần giao'].to_numpy(dtype=float)).astype(np.int64)
+    levels = [out[k].fillna(0).to_numpy(dtype=np.int64) for k in keys]
+    n_local = len(STOCK_LOCATIONS.local)
+    local_total = sum(levels[:n_local], np.zeros(len(out), dtype=np.int64))
+
+    if mode == 'allocate':
+        pids = out['pid'].fillna(-1).to_numpy(dtype=np.int64)
+        before = _allocation_demand_before(pids, np.where(found, need, 0), out['ĐV nhận'], priority)
+    else:
+        before = np.zeros(len(out), dtype=np.int64)
+
+    # Lấy lần lượt qua từng kho theo thứ tự, sau khi trừ phần các dòng trước đã lấy:
+    # taken = SL lấy được tính đến hết kho hiện tại, phần của kho = hiệu với kho trước.
+    # Kho tồn âm (bán vượt) coi như 0 khi lấy hàng; cột tồn vẫn hiện số thật
+    cum = np.zeros(len(out), dtype=np.int64)
+    taken_prev = np.zeros(len(out), dtype=np.int64)
+    allocs = []
+    conditions, statuses = [~found], [PO_STATUS_NOT_FOUND]
+    for loc, level in zip(order, levels):
+        cum = cum + np.maximum(level, 0)
+        taken = np.where(found, np.clip(cum - before, 0, need), 0)
+        allocs.append(taken - taken_prev)
+        conditions.append(taken == need)
+        statuses.append(loc.status)
+        taken_prev = taken
+    shortage = np.where(found, need - taken_prev, need)
+
+    status = np.select(conditions, statuses, default=PO_STATUS_SHORT)
+
+    values = (
+        [out['Mã SP'], out['Tên SP'].where(found, 'KHÔNG TÌM THẤY'), out['ĐV nhận'], need]
+        + levels[:n_local] + [local_total] + levels[n_local:]
+        + [status] + allocs + [shortage]
+    )
+    return pd.DataFrame(dict(zip(KIEMTRAPO_COLUMNS, values)), columns=KIEMTRAPO_COLUMNS)
+
+
+PO_WRITE_CHUNK = 5000
+
+
+def process_po_and_build_report(file_bytes, fresh=False, fmt='xlsx', progress=None):
+    # progress(stage): báo tiến độ cho job PO, có thể raise JobCancelled để dừng
+    progress = progress or (lambda stage: None)
+
+    progress("Đọc file PO")
+    df, err = _read_po_with_auto_header(file_bytes)
+    if df is None:
+        return None, err
+
+    if df.empty:
+        return None, "File PO không có dữ liệu."
 
-    df['Mã SP'] = df['Mã SP'].astype(str).str.strip().str.upper()
+    df['Mã SP'] = df['Mã SP'].map(lambda v: '' if v is None else str(v)).str.strip().str.upper()
     df['SL cần giao'] = pd.to_numeric(df['SL cần giao'], errors='coerce').fillna(0)
     df = df[(df['Mã SP'] != "") & (df['SL cần giao'] > 0)]
 
@@ -435,220 +2131,524 @@ def process_po_and_build_report(file_bytes: bytes):
 
     try:
         codes = sorted(df['Mã SP'].unique().tolist())
-        products = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'product.product', 'search_read',
-            [[(PRODUCT_CODE_FIELD, 'in', codes)]],
-            {'fields': ['id', 'display_name', PRODUCT_CODE_FIELD]}
-        )
+        progress(f"Tra {len(codes)} mã SP")
+        if fresh:
+            products = models.execute_kw(
+                ODOO_DB, uid, ODOO_PASSWORD,
+                'product.product', 'search_read',
+                [[(PRODUCT_CODE_FIELD, 'in', codes)]],
+                {'fields': ['id', 'display_name', PRODUCT_CODE_FIELD]}
+            )
 
-        code_map = {}
-        for p in products:
-            c = str(p.get(PRODUCT_CODE_FIELD) or "").strip().upper()
-            code_map[c] = p
+            code_map = {}
+            for p in products:
+                code_map[normalize_code(p.get(PRODUCT_CODE_FIELD))] = p
+        else:
+            code_map = PRODUCT_CATALOG.lookup_many(codes, models, uid)
 
-        location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
-        stock_cache = {}
-        rows = []
+        writer = ReportWriter('KiemTraPO', KIEMTRAPO_COLUMNS, fmt)
 
-        for _, r in df.iterrows():
-            code = r['Mã SP']
-            need_qty = int(round(r['SL cần giao']))
-            receiver = r['ĐV nhận']
+        pids = [p['id'] for p in code_map.values()]
+        progress(f"Lấy tồn kho {len(pids)} SP")
+        # Ma trận SP x kho cho mọi kho cấu hình, một truy vấn dù có bao nhiêu kho
+        if fresh:
+            matrix = load_inventory(models, uid, pids) if pids else {}
+        else:
+            matrix = INVENTORY.snapshot(models, uid).matrix
+        stock_map = {pid: stock_levels(matrix.get(pid)) for pid in pids}
 
-            prod = code_map.get(code)
-            if not prod:
-                rows.append({
-                    'Mã SP': code,
-                    'Tên SP': 'KHÔNG TÌM THẤY',
-                    'ĐV nhận': receiver,
-                    'SL cần giao': need_qty,
-                    'Tồn HN': 0,
-                    'Tồn Kho Nhập': 0,
-                    'Tổng tồn HN': 0,
-                    'Tồn HCM': 0,
-                    'Trạng thái': 'KHÔNG TÌM THẤY MÃ',
-                    'SL cần kéo từ HCM': 0,
-                    'SL thiếu': need_qty,
-                })
-                continue
+        progress(f"Phân bổ {len(df)} dòng PO")
+        result = evaluate_po(df, code_map, stock_map)
 
-            pid = prod['id']
-            name = prod['display_name']
+        total = len(result)
+        for start in range(0, total, PO_WRITE_CHUNK):
+            progress(f"Ghi báo cáo {start}/{total} dòng")
+            chunk = result.iloc[start:start + PO_WRITE_CHUNK]
+            writer.write_rows(zip(*(chunk[col].tolist() for col in KIEMTRAPO_COLUMNS)))
 
-            stock = _get_stock_for_product_with_cache(
-                models, uid, pid, location_ids, stock_cache
-            )
+        return writer.close(), None
 
-            hn  = stock['hn']
-            hcm = stock['hcm']
+    except JobCancelled:
+        raise
+    except Exception as e:
+        return None, f"Lỗi khi xử lý PO: {e}"
 
-            tr = get_transit_quantity(
-                models, uid, pid,
-                location_ids.get('HN_TRANSIT', {}).get('id')
-            )
 
-            total_hn = hn + tr
-            pull = 0
-            shortage = 0
+# ---------------- Worker pool (Odoo / pandas) ----------------
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', '4'))
+WORKER_QUEUE_MAX = int(os.environ.get('WORKER_QUEUE_MAX', '50'))
+WORKER_PER_USER_MAX = int(os.environ.get('WORKER_PER_USER_MAX', '3'))
+# Số update Telegram xử lý song song; =1 thì mọi handler xếp hàng sau nhau
+# và pool ở trên không bao giờ phục vụ quá một user cùng lúc
+BOT_CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', '32'))
+
+
+class WorkQueueFull(Exception):
+    pass
+
+
+# Pool luồng có giới hạn: mỗi user một hàng đợi riêng, các worker lấy việc
+# xoay vòng giữa các user để một báo cáo nặng không chặn tra cứu của người khác.
+class FairWorkPool:
+    def __init__(self, threads=WORKER_THREADS, max_queued=WORKER_QUEUE_MAX,
+                 per_user_max=WORKER_PER_USER_MAX, name='odoo-worker'):
+        self.name = name
+        self.threads = max(1, threads)
+        self.max_queued = max_queued
+        self.per_user_max = per_user_max
+
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._per_user = {}
+        self._queued = 0
+        self._running = 0
+        self._workers = []
+
+    def _ensure_workers(self):
+        while len(self._workers) < self.threads:
+            t = threading.Thread(target=self._worker, daemon=True,
+                                 name=f"{self.name}-{len(self._workers)}")
+            self._workers.append(t)
+            t.start()
+
+    def submit(self, user_key, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._queued >= self.max_queued:
+                raise WorkQueueFull("Bot đang bận, hàng đợi đã đầy. Vui lòng thử lại sau ít phút.")
+            if self._per_user.get(user_key, 0) >= self.per_user_max:
+                raise WorkQueueFull(
+                    f"Bạn đang có {self.per_user_max} yêu cầu chưa xong, chờ xong rồi gửi tiếp nha."
+                )
 
-            if need_qty <= hn:
-                status = "ĐỦ tại kho HN (201/201)"
-            elif need_qty <= total_hn:
-                status = "ĐỦ (HN + Kho nhập HN)"
-            else:
-                req = need_qty - total_hn
-                if req <= hcm:
-                    pull = req
-                    status = "CẦN KÉO HÀNG TỪ HCM"
-                else:
-                    pull = hcm
-                    shortage = req - hcm
-                    status = "THIẾU DÙ ĐÃ KÉO TỐI ĐA"
-
-            rows.append({
-                'Mã SP': code,
-                'Tên SP': name,
-                'ĐV nhận': receiver,
-                'SL cần giao': need_qty,
-                'Tồn HN': hn,
-                'Tồn Kho Nhập': tr,
-                'Tổng tồn HN': total_hn,
-                'Tồn HCM': hcm,
-                'Trạng thái': status,
-                'SL cần kéo từ HCM': pull,
-                'SL thiếu': shortage,
-            })
+            # Giữ context của handler (nhãn lệnh cho metrics) khi chạy trong worker
+            ctx = contextvars.copy_context()
+            self._queues.setdefault(user_key, deque()).append((future, ctx, fn, args, kwargs))
+            self._per_user[user_key] = self._per_user.get(user_key, 0) + 1
+            self._queued += 1
+            self._ensure_workers()
+            self._cond.notify()
+        return future
+
+    def _next_item(self):
+        user_key, items = next(iter(self._queues.items()))
+        item = items.popleft()
+        if items:
+            self._queues.move_to_end(user_key)
+        else:
+            del self._queues[user_key]
+        self._queued -= 1
+        return user_key, item
 
-        df_out = pd.DataFrame(rows)
-        cols = [
-            'Mã SP','Tên SP','ĐV nhận','SL cần giao',
-            'Tồn HN','Tồn Kho Nhập','Tổng tồn HN','Tồn HCM',
-            'Trạng thái','SL cần kéo từ HCM','SL thiếu'
-        ]
-        df_out = df_out[cols]
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                user_key, (future, ctx, fn, args, kwargs) = self._next_item()
+                self._running += 1
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    started = time.perf_counter()
+                    try:
+                        future.set_result(ctx.run(fn, *args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+                    METRICS.observe('bot_command_duration_seconds', time.perf_counter() - started,
+                                    command=ctx.get(CURRENT_COMMAND), pool=self.name)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    left = self._per_user.get(user_key, 1) - 1
+                    if left > 0:
+                        self._per_user[user_key] = left
+                    else:
+                        self._per_user.pop(user_key, None)
+
+    async def run(self, user_key, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(user_key, fn, *args, **kwargs))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'threads': len(self._workers),
+                'queued': self._queued,
+                'running': self._running,
+                'users': len(self._per_user),
+            }
+
+
+WORK_POOL = FairWorkPool()
+
+
+def _user_key(update: Update):
+    user = update.effective_user
+    return user.id if user else update.message.chat_id
+
+
+# ---------------- PO jobs ----------------
+PO_JOB_WORKERS = int(os.environ.get('PO_JOB_WORKERS', '2'))
+PO_JOB_QUEUE_MAX = int(os.environ.get('PO_JOB_QUEUE_MAX', '20'))
+PO_JOB_PER_USER = int(os.environ.get('PO_JOB_PER_USER', '2'))
+PO_JOB_KEEP = int(os.environ.get('PO_JOB_KEEP', '100'))
+PO_JOB_PROGRESS_INTERVAL = float(os.environ.get('PO_JOB_PROGRESS_INTERVAL', '3'))
+PO_UPLOAD_WINDOW = int(os.environ.get('PO_UPLOAD_WINDOW', '600'))
+
+PO_JOB_STATES = {
+    'queued': '⏳ Đang chờ',
+    'running': '⚙️ Đang chạy',
+    'done': '✅ Xong',
+    'failed': '❌ Lỗi',
+    'cancelled': '🚫 Đã huỷ',
+}
 
-        buf = io.BytesIO()
-        df_out.to_excel(buf, index=False, sheet_name='KiemTraPO')
-        buf.seek(0)
-        return buf, None
 
-    except Exception as e:
-        return None, f"Lỗi khi xử lý PO: {e}"
+class JobCancelled(Exception):
+    pass
+
+
+class PoJob:
+    def __init__(self, job_id, user_key, chat_id, file_name):
+        self.id = job_id
+        self.user_key = user_key
+        self.chat_id = chat_id
+        self.file_name = file_name
+        self.state = 'queued'
+        self.stage = ''
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def progress(self, stage):
+        # Gọi từ worker giữa các bước xử lý
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.stage = stage
+
+    def status_text(self):
+        text = f"Job #{self.id} ({self.file_name}): {PO_JOB_STATES[self.state]}"
+        if self.state == 'running' and self.stage:
+            text += f" – {self.stage}"
+        if self.started_at:
+            end = self.finished_at or time.time()
+            text += f" ({end - self.started_at:.0f}s)"
+        return text
+
+
+# Mỗi file PO là 1 job có id; chạy trên pool worker riêng để PO lớn không
+# chiếm worker của tra mã / kéo hàng. Huỷ được khi đang chờ hoặc giữa các bước.
+class PoJobManager:
+    def __init__(self, workers=PO_JOB_WORKERS, max_queued=PO_JOB_QUEUE_MAX,
+                 per_user=PO_JOB_PER_USER, keep=PO_JOB_KEEP):
+        self.pool = FairWorkPool(threads=workers, max_queued=max_queued,
+                                 per_user_max=per_user, name='po-worker')
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._seq = 0
+
+    def submit(self, user_key, chat_id, file_name, fn, *args, **kwargs):
+        with self._lock:
+            self._seq += 1
+            job = PoJob(self._seq, user_key, chat_id, file_name)
+
+        # WorkQueueFull được đẩy lên cho handler báo lại user
+        job.future = self.pool.submit(user_key, self._run, job, fn, *args, **kwargs)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        return job
+
+    def _run(self, job, fn, *args, **kwargs):
+        try:
+            job.progress("Bắt đầu")
+            job.state = 'running'
+            job.started_at = time.time()
+            result = fn(*args, progress=job.progress, **kwargs)
+            job.state = 'done'
+            return result
+        except JobCancelled:
+            job.state = 'cancelled'
+            raise
+        except BaseException:
+            job.state = 'failed'
+            raise
+        finally:
+            job.finished_at = time.time()
+
+    def _trim(self):
+        finished = [jid for jid, j in self._jobs.items() if j.finished]
+        for jid in finished[:max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[jid]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id, user_key):
+        job = self.get(job_id)
+        if job is None or job.user_key != user_key:
+            return None
+        if job.finished:
+            return job
+        job._cancel.set()
+        if job.future.cancel():
+            # chưa tới lượt chạy -> huỷ ngay
+            job.state = 'cancelled'
+            job.finished_at = time.time()
+        return job
+
+    def jobs_for(self, user_key):
+        with self._lock:
+            return [j for j in self._jobs.values() if j.user_key == user_key]
+
+    async def follow(self, job, on_update):
+        # Chờ job xong, gọi on_update(job) mỗi khi trạng thái đổi
+        waiter = asyncio.wrap_future(job.future)
+        last = None
+        while True:
+            done = waiter.done()
+            text = job.status_text()
+            if text != last:
+                last = text
+                await on_update(job)
+            if done:
+                return waiter
+            await asyncio.wait({waiter}, timeout=PO_JOB_PROGRESS_INTERVAL)
+
+
+PO_JOBS = PoJobManager()
+
+
+# ---------------- Single-flight ----------------
+METRICS.describe('singleflight_calls_total', 'counter',
+                 "Yêu cầu qua single-flight: leader = tự tính, coalesced = dùng chung kết quả")
+METRICS.describe('singleflight_inflight', 'gauge', "Số yêu cầu single-flight đang tính")
+
+
+# Nhiều người hỏi cùng một thứ cùng lúc (cùng mã SP, cùng /keohang) thì chỉ
+# tính 1 lần; những người đến sau chờ và dùng chung kết quả đang tính.
+# Chạy trên event loop của bot nên không cần khoá.
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+
+    async def run(self, key, factory):
+        # factory() -> coroutine; key[0] là loại yêu cầu, dùng làm nhãn metrics
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+            METRICS.inc('singleflight_calls_total', kind=key[0], role='leader')
+        else:
+            METRICS.inc('singleflight_calls_total', kind=key[0], role='coalesced')
+        # shield: 1 người huỷ không làm hỏng kết quả của những người đang chờ
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def inflight(self):
+        return len(self._inflight)
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+# ---------------- Report cache ----------------
+REPORT_CACHE_ENTRIES = int(os.environ.get('REPORT_CACHE_ENTRIES', '32'))
+REPORT_CACHE_BYTES = int(os.environ.get('REPORT_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+METRICS.describe('report_cache_requests_total', 'counter', "Tra cache báo cáo: hit / miss")
+METRICS.describe('report_cache_size', 'gauge', "Cache báo cáo: số file và tổng byte")
+
+
+class CachedReport:
+    __slots__ = ('key', 'data', 'file', 'count', 'message', 'file_id', 'send_lock')
+
+    def __init__(self, key, data, count, message, file=None):
+        self.key = key
+        self.data = data
+        # Báo cáo không lưu cache: giữ nguyên file tạm (có thể đã tràn ra đĩa) để gửi thẳng;
+        # file tự đóng khi không còn ai giữ báo cáo
+        self.file = file
+        self.count = count
+        self.message = message
+        self.file_id = None
+        self.send_lock = asyncio.Lock()
+
+    @property
+    def ok(self):
+        return self.data is not None or self.file is not None
+
+    def document(self, filename):
+        # Đã gửi 1 lần thì gửi lại bằng file_id, không phải upload lại
+        if self.file_id:
+            return self.file_id
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        self.file.seek(0)
+        return InputFile(self.file, filename=filename, read_file_handle=False)
+
+
+# Cache file báo cáo đã dựng xong, khoá theo version tồn kho / danh mục SP
+# (và sha256 của file PO). LRU, giới hạn cả số file lẫn tổng dung lượng.
+class ReportCache:
+    def __init__(self, max_entries=REPORT_CACHE_ENTRIES, max_bytes=REPORT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        METRICS.inc('report_cache_requests_total', kind=key[0],
+                    result='hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, entry):
+        size = len(entry.data)
+        if size > self.max_bytes:
+            return entry
+        with self._lock:
+            old = self._entries.pop(entry.key, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._entries[entry.key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.data)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+
+REPORT_CACHE = ReportCache()
+
+
+def _report_entry(key, buf, count, message):
+    # Chỉ đọc file báo cáo ra bytes khi sẽ lưu cache và vừa REPORT_CACHE_BYTES;
+    # báo cáo fresh / quá lớn gửi thẳng từ file tạm nên RAM không tăng theo cỡ file
+    size = buf.seek(0, io.SEEK_END)
+    buf.seek(0)
+    if key is None or size > REPORT_CACHE.max_bytes:
+        return CachedReport(key, None, count, message, file=buf)
+    with buf:
+        return REPORT_CACHE.put(CachedReport(key, buf.read(), count, message))
+
+
+def _report_versions(models=None, uid=None):
+    PRODUCT_CATALOG.ensure_loaded(models, uid)
+    return INVENTORY.snapshot(models, uid).version, PRODUCT_CATALOG.version
+
+
+def build_keohang_report(fresh=False, fmt='xlsx'):
+    # Trả CachedReport (bytes, dùng chung được cho single-flight và cache)
+    key = None
+    if not fresh:
+        key = ('keohang', fmt, TARGET_MIN_QTY) + _report_versions()
+        cached = REPORT_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    buf, count, msg = get_stock_data(fresh, fmt)
+    if buf is None:
+        return CachedReport(key, None, count, msg)
+    return _report_entry(key, buf, count, msg)
+
+
+def build_po_report(file_buffer, fresh=False, fmt='xlsx', progress=None):
+    # Job /checkpo: trả (CachedReport, None) hoặc (None, lỗi)
+    key = None
+    if not fresh:
+        digest = hashlib.sha256(file_buffer.getbuffer()).hexdigest()
+        key = (
+            'checkpo', digest, fmt, PO_ALLOCATION_MODE, tuple(PO_RECEIVER_PRIORITY)
+        ) + _report_versions()
+        cached = REPORT_CACHE.get(key)
+        if cached is not None:
+            return cached, None
+
+    buf, err = process_po_and_build_report(file_buffer, fresh, fmt, progress=progress)
+    if buf is None:
+        return None, err
+    return _report_entry(key, buf, None, None), None
 
 
 # ---------------- Handle product code ----------------
-async def handle_product_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    register_chat_id(chat_id)
-
-    product_code = update.message.text.strip().upper()
-    await update.message.reply_text(
-        f"đang tra tồn cho `{product_code}`, vui lòng chờ!",
-        parse_mode='Markdown'
-    )
-
+def lookup_product_stock(product_code, fresh=False):
+    # Chạy trong worker pool; trả về (nội dung trả lời, parse_mode)
     uid, models, error_msg = connect_odoo()
     if not uid:
-        await update.message.reply_text(
-            f"❌ lỗi kết nối odoo. chi tiết: `{escape_markdown(error_msg)}`",
-            parse_mode='Markdown'
-        )
-        return
+        return f"❌ lỗi kết nối odoo. chi tiết: `{escape_markdown(error_msg)}`", 'Markdown'
 
     try:
-        location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
-
-        hn_stock_id   = location_ids.get('HN_STOCK', {}).get('id')
-        hn_transit_id = location_ids.get('HN_TRANSIT', {}).get('id')
-        hcm_stock_id  = location_ids.get('HCM_STOCK', {}).get('id')
-
-        products = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'product.product', 'search_read',
-            [[(PRODUCT_CODE_FIELD, '=', product_code)]],
-            {'fields': ['display_name', 'id']}
-        )
-
-        if not products:
-            await update.message.reply_text(f"❌ Không tìm thấy sản phẩm nào có mã `{product_code}`")
-            return
-
-        product = products[0]
-        product_id = product['id']
-        product_name = product['display_name']
-
-        def get_qty_available(location_id):
-            if not location_id:
-                return 0
-            stock_product_info = models.execute_kw(
+        if fresh:
+            products = models.execute_kw(
                 ODOO_DB, uid, ODOO_PASSWORD,
-                'product.product', 'read',
-                [[product_id]],
-                {'fields': ['qty_available'], 'context': {'location': location_id}}
+                'product.product', 'search_read',
+                [[(PRODUCT_CODE_FIELD, '=', product_code)]],
+                {'fields': ['display_name', 'id']}
             )
-            if stock_product_info and stock_product_info[0]:
-                return int(round(stock_product_info[0].get('qty_available', 0.0)))
-            return 0
+            product = products[0] if products else None
+        else:
+            product = PRODUCT_CATALOG.lookup(product_code, models, uid)
 
-        hn_stock_qty  = get_qty_available(hn_stock_id)
-        hcm_stock_qty = get_qty_available(hcm_stock_id)
-        hn_transit_qty = get_transit_quantity(models, uid, product_id, hn_transit_id)
+        if not product:
+            msg = f"❌ Không tìm thấy sản phẩm nào có mã `{product_code}`"
+            suggestions = PRODUCT_CATALOG.suggest(product_code)
+            if suggestions:
+                msg += "\nCó phải bạn muốn tìm: " + ", ".join(suggestions)
+            return msg, None
 
-        quant_domain = [('product_id', '=', product_id), ('available_quantity', '>', 0)]
-        quant_data = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            'stock.quant', 'search_read',
-            [quant_domain],
-            {'fields': ['location_id', 'available_quantity']}
-        )
+        product_id = product['id']
+        product_name = product['display_name']
 
-        location_ids_list = list({q['location_id'][0] for q in quant_data if q.get('location_id')})
-        if location_ids_list:
-            location_info = models.execute_kw(
-                ODOO_DB, uid, ODOO_PASSWORD,
-                'stock.location', 'read',
-                [location_ids_list],
-                {'fields': ['id', 'display_name', 'complete_name', 'usage']}
-            )
+        snapshot = None if fresh else INVENTORY.peek()
+        if snapshot is not None:
+            cells = snapshot.get(product_id)
         else:
-            location_info = []
-
-        loc_map = {l['id']: l for l in location_info}
+            # fresh, hoặc vừa khởi động và kho tồn chung chưa nạp xong: đọc riêng SP này
+            # thay vì chờ nạp toàn bộ (luồng nền 'inventory' đang nạp song song)
+            cells = load_inventory(models, uid, [product_id]).get(product_id)
+        levels = stock_levels(cells)
+
+        # Tồn chi tiết theo từng kho nội bộ: một read_group cho riêng SP này,
+        # tên kho lấy từ registry
+        leaves = load_stock_details(models, uid, product_id)
+        loc_names = LOCATION_REGISTRY.names(models, uid)
         stock_details = {}
-
-        for q in quant_data:
-            loc_field = q.get('location_id')
-            if not loc_field:
-                continue
-
-            loc_id = loc_field[0]
-            qty = float(q.get('available_quantity', 0.0))
-            if qty <= 0:
-                continue
-
-            name_loc = (
-                loc_map.get(loc_id, {}).get('complete_name')
-                or loc_map.get(loc_id, {}).get('display_name')
-                or f"ID:{loc_id}"
-            )
-
+        for loc_id, qty in leaves.items():
+            name_loc = loc_names.get(loc_id) or f"ID:{loc_id}"
             stock_details[name_loc] = stock_details.get(name_loc, 0) + int(qty)
 
-        total_hn = hn_stock_qty + hn_transit_qty
-
-        recommend = 0
-        if total_hn < TARGET_MIN_QTY:
-            need = TARGET_MIN_QTY - total_hn
-            recommend = min(need, hcm_stock_qty)
+        recommend = STOCK_LOCATIONS.suggestion(levels)
 
         priority_items = []
         other_items = []
         used_names = set()
 
-        for code in PRIORITY_LOCATIONS:
+        for loc in STOCK_LOCATIONS.priority:
             for name, qty in stock_details.items():
-                if code.lower() in name.lower() and name not in used_names:
+                if loc.match.lower() in name.lower() and name not in used_names:
                     priority_items.append((name, qty))
                     used_names.add(name)
                     break
@@ -662,10 +2662,9 @@ async def handle_product_code(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         msg = (
             f"{product_code} {product_name}\n"
-            f"Tồn kho HN: {int(hn_stock_qty)}\n"
-            f"Tồn kho HCM: {int(hcm_stock_qty)}\n"
-            f"Tồn kho nhập Hà Nội: {int(hn_transit_qty)}\n"
-            f"=> đề xuất nhập thêm {int(recommend)} sp để hn đủ tồn {TARGET_MIN_QTY} sản phẩm.\n\n"
+            + "".join(f"{loc.name}: {levels[loc.key]}\n" for loc in STOCK_LOCATIONS)
+            + f"=> đề xuất nhập thêm {int(recommend)} sp để {LOCAL_GROUP_LABEL.lower()} "
+            f"đủ tồn {TARGET_MIN_QTY} sản phẩm.\n\n"
             "2/ Tồn kho chi tiết(Có hàng):"
         )
 
@@ -675,42 +2674,124 @@ async def handle_product_code(update: Update, context: ContextTypes.DEFAULT_TYPE
         else:
             msg += "\nKhông có tồn kho chi tiết lớn hơn 0."
 
-        await update.message.reply_text(msg.strip())
+        return msg.strip(), None
 
     except Exception as e:
         logger.error(f"lỗi khi tra tồn: {e}")
-        await update.message.reply_text(f"❌ lỗi khi tra tồn: {e}")
+        return f"❌ lỗi khi tra tồn: {e}", None
+
+
+async def handle_product_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    register_chat_id(chat_id)
+
+    product_code = update.message.text.strip().upper()
+    # "MÃ!" = bỏ qua kho tồn dùng chung, đọc trực tiếp từ Odoo
+    fresh = product_code.endswith('!')
+    product_code = product_code.rstrip('!').strip()
+    await update.message.reply_text(
+        f"đang tra tồn cho `{product_code}`, vui lòng chờ!",
+        parse_mode='Markdown'
+    )
+
+    try:
+        with command_scope('lookup'):
+            msg, parse_mode = await SINGLE_FLIGHT.run(
+                ('lookup', normalize_code(product_code), fresh),
+                lambda: WORK_POOL.run(_user_key(update), lookup_product_stock, product_code, fresh),
+            )
+    except WorkQueueFull as e:
+        await update.message.reply_text(f"⏳ {e}")
+        return
+
+    await update.message.reply_text(msg, parse_mode=parse_mode)
 
 
 # ---------------- Telegram Handlers ----------------
+FRESH_ARGS = {'fresh', 'live', 'moi', 'mới', '!'}
+
+
+def _wants_fresh(args):
+    # /keohang fresh, /checkpo fresh: bỏ qua kho tồn dùng chung
+    return any(str(a).strip().lower() in FRESH_ARGS for a in (args or []))
+
+
 async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     register_chat_id(chat_id)
 
     await update.message.reply_text("Đang kiểm tra kết nối odoo, xin chờ...")
-    uid, _, error_msg = connect_odoo()
+    try:
+        with command_scope('ping'):
+            uid, client, error_msg = await WORK_POOL.run(_user_key(update), connect_odoo)
+    except WorkQueueFull as e:
+        await update.message.reply_text(f"⏳ {e}")
+        return
+
     if uid:
-        await update.message.reply_text(f"✅ Thành công! Kết nối Odoo DB: {ODOO_DB}")
+        stats = client.stats.snapshot()
+        await update.message.reply_text(
+            f"✅ Thành công! Kết nối Odoo DB: {ODOO_DB} ({client.protocol})\n"
+            f"Kết nối mở mới: {stats['connections_opened']}, "
+            f"tái sử dụng: {stats['connections_reused']}, "
+            f"đăng nhập: {stats['logins'] + stats['relogins']} lần, "
+            f"tổng lệnh gọi: {stats['calls']}"
+        )
     else:
         await update.message.reply_text(f"❌ Lỗi: {error_msg}")
 
 
+async def _send_report(message, report, filename, caption):
+    try:
+        sent = await message.reply_document(
+            document=report.document(filename), filename=filename, caption=caption
+        )
+    except BadRequest:
+        if not report.file_id:
+            raise
+        # file_id hết hạn / không dùng được -> upload lại từ bytes / file
+        report.file_id = None
+        sent = await message.reply_document(
+            document=report.document(filename), filename=filename, caption=caption
+        )
+    if sent.document:
+        report.file_id = sent.document.file_id
+
+
+async def _reply_report(message, report, filename, caption):
+    if report.file is None:
+        return await _send_report(message, report, filename, caption)
+    # Gửi thẳng từ file tạm: những người chờ chung một báo cáo (single-flight) gửi
+    # lần lượt, người sau dùng lại file_id của lần upload đầu
+    async with report.send_lock:
+        return await _send_report(message, report, filename, caption)
+
+
 async def excel_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     register_chat_id(chat_id)
 
     await update.message.reply_text("⌛️ Iem đang xử lý dữ liệu và tạo báo cáo Excel...")
-    excel_buffer, item_count, error_msg = get_stock_data()
+    try:
+        fmt = report_format(context.args)
+        fresh = _wants_fresh(context.args)
+        with command_scope('keohang'):
+            report = await SINGLE_FLIGHT.run(
+                ('keohang', fresh, fmt),
+                lambda: WORK_POOL.run(_user_key(update), build_keohang_report, fresh, fmt),
+            )
+    except WorkQueueFull as e:
+        await update.message.reply_text(f"⏳ {e}")
+        return
 
-    if excel_buffer is None:
-        await update.message.reply_text(f"❌ Lỗi: {error_msg}")
+    if not report.ok:
+        await update.message.reply_text(f"❌ Lỗi: {report.message}")
         return
 
-    if item_count > 0:
-        await update.message.reply_document(
-            document=excel_buffer,
-            filename="de_xuat_keo_hang.xlsx",
-            caption=f"Đã tìm thấy {item_count} sản phẩm cần kéo hàng."
+    if report.count > 0:
+        await _reply_report(
+            update.message, report, report_filename("de_xuat_keo_hang", fmt),
+            f"Đã tìm thấy {report.count} sản phẩm cần kéo hàng."
         )
     else:
         await update.message.reply_text(
@@ -725,9 +2806,12 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.from_user.first_name
     await update.message.reply_text(
         f"Chào {name}!\n"
-        "1. Gõ mã sp để tra tồn.\n"
-        "2. /keohang để tạo báo cáo Excel.\n"
-        "3. /ping để kiểm tra kết nối Odoo."
+        "1. Gõ mã sp để tra tồn (thêm ! ở cuối để lấy số liệu trực tiếp, vd: ABC123!).\n"
+        "2. /keohang để tạo báo cáo Excel (/keohang fresh để lấy số liệu trực tiếp).\n"
+        "3. /checkpo để kiểm tra file PO (/checkpo fresh để lấy số liệu trực tiếp).\n"
+        "   Thêm csv hoặc gz sau lệnh để nhận file CSV / CSV nén, vd: /keohang csv.\n"
+        "   /jobs để xem các job PO, /cancel <số job> để huỷ.\n"
+        "4. /ping để kiểm tra kết nối Odoo."
     )
 
 
@@ -735,9 +2819,42 @@ async def checkpo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     register_chat_id(chat_id)
 
-    context.user_data['waiting_for_po'] = True
+    # Nhận file PO trong PO_UPLOAD_WINDOW giây, gửi nhiều file cũng được
+    context.user_data['po_window_until'] = time.time() + PO_UPLOAD_WINDOW
+    context.user_data['po_fresh'] = _wants_fresh(context.args)
+    context.user_data['po_format'] = report_format(context.args)
     await update.message.reply_text(
-        "Ok, gửi file PO Excel (.xlsx) để iem kiểm tra tồn kho theo mẫu đối tác gửi nha!"
+        "Ok, gửi file PO Excel (.xlsx) để iem kiểm tra tồn kho theo mẫu đối tác gửi nha!\n"
+        f"Trong {PO_UPLOAD_WINDOW // 60} phút tới gửi mấy file cũng được, "
+        "/jobs để xem các job, /cancel <số job> để huỷ."
+    )
+
+
+async def _follow_po_job(message, status_msg, job, fmt):
+    async def on_update(j):
+        try:
+            await status_msg.edit_text(j.status_text())
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"Không cập nhật được tiến độ job #{j.id}: {e}")
+        except (NetworkError, RetryAfter) as e:
+            logger.warning(f"Không cập nhật được tiến độ job #{j.id}: {e}")
+
+    waiter = await PO_JOBS.follow(job, on_update)
+    if waiter.cancelled() or isinstance(waiter.exception(), JobCancelled):
+        return
+    if waiter.exception() is not None:
+        await message.reply_text(f"❌ Có lỗi xảy ra khi xử lý PO: {waiter.exception()}")
+        return
+
+    report, error_msg = waiter.result()
+    if report is None:
+        await message.reply_text(f"❌ Có lỗi xảy ra khi xử lý PO: {error_msg}")
+        return
+
+    await _reply_report(
+        message, report, report_filename("kiem_tra_po", fmt),
+        f"❤️ Iem gửi chị file kiểm tra PO (job #{job.id}) và đối chiếu tồn kho đây ạ!"
     )
 
 
@@ -745,11 +2862,9 @@ async def handle_po_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     register_chat_id(chat_id)
 
-    if not context.user_data.get('waiting_for_po'):
+    if time.time() > context.user_data.get('po_window_until', 0):
         return
 
-    context.user_data['waiting_for_po'] = False
-
     document = update.message.document
     if not document:
         await update.message.reply_text("Không nhận được file, vui lòng gửi lại file Excel (.xlsx).")
@@ -760,30 +2875,103 @@ async def handle_po_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Chỉ hỗ trợ file Excel định dạng .xlsx thôi nha.")
         return
 
-    await update.message.reply_text("⌛️ Iem đang xử lý file PO, chờ em xíu xìu xiu nha...")
+    if document.file_size and document.file_size > PO_MAX_FILE_BYTES:
+        await update.message.reply_text(
+            f"File PO quá lớn, tối đa {PO_MAX_FILE_BYTES // 1024} KB thôi nha."
+        )
+        return
+
+    fmt = context.user_data.get('po_format', 'xlsx')
 
     try:
         file = await document.get_file()
-        file_bytes = await file.download_as_bytearray()
+        file_buffer = io.BytesIO()
+        await file.download_to_memory(out=file_buffer)
     except Exception as e:
         await update.message.reply_text(f"❌ Lỗi khi tải file PO: {e}")
         return
 
-    excel_buffer, error_msg = process_po_and_build_report(bytes(file_bytes))
-    if excel_buffer is None:
-        await update.message.reply_text(f"❌ Có lỗi xảy ra khi xử lý PO: {error_msg}")
+    try:
+        with command_scope('checkpo'):
+            job = PO_JOBS.submit(
+                _user_key(update), chat_id, document.file_name or "PO.xlsx",
+                build_po_report, file_buffer,
+                context.user_data.get('po_fresh', False), fmt
+            )
+    except WorkQueueFull as e:
+        await update.message.reply_text(f"⏳ {e}")
+        return
+
+    status_msg = await update.message.reply_text(
+        f"⌛️ Iem nhận file PO rồi, job #{job.id}, chờ em xíu xìu xiu nha..."
+    )
+    # Theo dõi job ở task riêng để handler trả về ngay
+    context.application.create_task(
+        _follow_po_job(update.message, status_msg, job, fmt), update=update
+    )
+
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    register_chat_id(chat_id)
+
+    jobs = PO_JOBS.jobs_for(_user_key(update))
+    if not jobs:
+        await update.message.reply_text("Chưa có job PO nào.")
         return
 
-    await update.message.reply_document(
-        document=excel_buffer,
-        filename="kiem_tra_po.xlsx",
-        caption="❤️ Iem gửi chị file kiểm tra PO và đối chiếu tồn kho đây ạ!"
+    active = [j for j in jobs if not j.finished]
+    recent = [j for j in jobs if j.finished][-5:]
+    lines = [j.status_text() for j in active + recent]
+    await update.message.reply_text(
+        f"Job PO đang chạy / chờ: {len(active)}\n" + "\n".join(lines)
     )
 
 
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    register_chat_id(chat_id)
+
+    user_key = _user_key(update)
+    if context.args:
+        try:
+            job_ids = [int(str(context.args[0]).lstrip('#'))]
+        except ValueError:
+            await update.message.reply_text("Cú pháp: /cancel <số job>, vd: /cancel 12")
+            return
+    else:
+        # Không ghi số job -> huỷ hết job chưa xong của mình
+        job_ids = [j.id for j in PO_JOBS.jobs_for(user_key) if not j.finished]
+        if not job_ids:
+            await update.message.reply_text("Không có job PO nào đang chạy.")
+            return
+
+    lines = []
+    for job_id in job_ids:
+        job = PO_JOBS.cancel(job_id, user_key)
+        if job is None:
+            lines.append(f"Không tìm thấy job #{job_id}.")
+        elif job.state in ('done', 'failed'):
+            lines.append(f"Job #{job_id} đã xong, không huỷ được.")
+        elif job.state == 'cancelled':
+            lines.append(f"🚫 Đã huỷ job #{job_id}.")
+        else:
+            lines.append(f"🚫 Job #{job_id} sẽ dừng sau bước đang chạy.")
+    await update.message.reply_text("\n".join(lines))
+
+
 # ---------------- HTTP Ping Server ----------------
 class PingHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            body = METRICS.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
         self.send_response(200)
         self.send_header("Content-type", "text/plain")
         self.end_headers()
@@ -802,7 +2990,7 @@ def start_http():
         logger.error(f"Lỗi HTTP server: {e}")
 
 
-threading.Thread(target=start_http, daemon=True).start()
+SERVICES.register('http', start_http)
 
 # ---------------- AUTO-PING ----------------
 PING_URL = "https://google.com"
@@ -817,140 +3005,637 @@ def keep_alive_ping():
         time.sleep(300)
 
 
-threading.Thread(target=keep_alive_ping, daemon=True).start()
+SERVICES.register('keep_alive_ping', keep_alive_ping)
+
+# ---------------- Notification dispatcher ----------------
+NOTIFY_CHAT_RATE = float(os.environ.get('NOTIFY_CHAT_RATE', '1'))       # tin / giây / chat
+NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', '25'))  # tin / giây toàn bot
+NOTIFY_DIGEST_MIN = int(os.environ.get('NOTIFY_DIGEST_MIN', '5'))       # 0 = không gộp tin
+NOTIFY_QUEUE_MAX = int(os.environ.get('NOTIFY_QUEUE_MAX', '5000'))
+NOTIFY_MAX_RETRIES = 5
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+
+
+class TokenBucket:
+    # Chỉ dùng trong event loop của bot nên không cần khóa
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_after_seconds(err):
+    value = err.retry_after
+    if hasattr(value, 'total_seconds'):
+        return value.total_seconds()
+    return float(value)
+
+
+# Hàng đợi gửi tin dài hạn: các luồng nền gọi submit(), event loop của Application
+# gửi bằng chính application.bot, giới hạn tốc độ theo từng chat và toàn cục.
+class NotificationDispatcher:
+    def __init__(self, chat_rate=NOTIFY_CHAT_RATE, global_rate=NOTIFY_GLOBAL_RATE,
+                 max_pending=NOTIFY_QUEUE_MAX):
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+
+        self._pending = deque()
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._bot = None
+        self._chat_queues = {}
+        self._chat_buckets = {}
+        self._tasks = set()
+        self._runner = None
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, chat_id, text, parse_mode=None):
+        with self._lock:
+            if len(self._pending) >= self._max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append((chat_id, text, parse_mode))
+            loop = self._loop
+
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self, bot):
+        # Tự giữ task thay vì application.create_task: post_init chạy lúc Application
+        # chưa running nên PTB không theo dõi task đó, tới lúc tắt vẫn treo pending
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.get_running_loop().create_task(self.run(bot))
+        return self._runner
+
+    async def stop(self):
+        with self._lock:
+            self._loop = None
+        tasks = [t for t in (self._runner, *self._tasks) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._runner = None
+        self._chat_queues.clear()
+        self._chat_buckets.clear()
+
+    async def run(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            if self._pending:
+                self._wakeup.set()
+
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            with self._lock:
+                items = list(self._pending)
+                self._pending.clear()
+
+            for chat_id, text, parse_mode in items:
+                self._chat_queue(chat_id).put_nowait((text, parse_mode))
+
+    def _chat_queue(self, chat_id):
+        q = self._chat_queues.get(chat_id)
+        if q is None:
+            q = self._chat_queues[chat_id] = asyncio.Queue()
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+            task = asyncio.get_running_loop().create_task(self._chat_worker(chat_id, q))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return q
+
+    async def _chat_worker(self, chat_id, q):
+        while True:
+            text, parse_mode = await q.get()
+            try:
+                await self._send(chat_id, text, parse_mode)
+            finally:
+                q.task_done()
+
+    async def _send(self, chat_id, text, parse_mode):
+        for attempt in range(NOTIFY_MAX_RETRIES):
+            await self._chat_buckets[chat_id].acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id, text, parse_mode=parse_mode)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                wait = _retry_after_seconds(e)
+                logger.warning(f"Telegram flood limit, chờ {wait}s rồi gửi lại tới {chat_id}")
+                await asyncio.sleep(wait)
+            except BadRequest as e:
+                if parse_mode and 'parse' in str(e).lower():
+                    # Tên SP có ký tự Markdown lạ -> gửi lại dạng text thường
+                    parse_mode = None
+                    continue
+                logger.error(f"Lỗi gửi thông báo tới {chat_id}: {e}")
+                break
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Lỗi mạng khi gửi tới {chat_id} (lần {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Lỗi gửi thông báo tới {chat_id}: {e}")
+                break
+        self.failed += 1
+
+
+NOTIFIER = NotificationDispatcher()
+
+
+def _split_message(header, lines, limit=TELEGRAM_MAX_MESSAGE_LEN):
+    chunks = []
+    current = header
+    for line in lines:
+        if len(current) + len(line) + 1 > limit and current != header:
+            chunks.append(current)
+            current = header
+        current += "\n" + line
+    chunks.append(current)
+    return chunks
+
+
+def notify_watch_changes(items, now_vn):
+    chat_ids = get_registered_chat_ids()
+    if not items or not chat_ids:
+        return
+
+    if NOTIFY_DIGEST_MIN and len(items) >= NOTIFY_DIGEST_MIN:
+        header = (
+            f"📦 *Cập nhật tồn kho 201/201 – {len(items)} SP thay đổi*\n"
+            f"*Thời gian:* {now_vn}\n"
+        )
+        lines = [
+            f"• {'NHẬP' if it['diff'] > 0 else 'XUẤT'} *{it['code']}* {it['name']}: "
+            f"{'+' if it['diff'] > 0 else ''}{it['diff']} → tồn {it['new_qty']} "
+            f"({it['picking_name']}, {it['actor']})"
+            for it in items
+        ]
+        messages = _split_message(header, lines)
+    else:
+        messages = []
+        for it in items:
+            diff = it['diff']
+            status = "NHẬP KHO" if diff > 0 else "XUẤT KHO"
+            messages.append(
+                f"📦 *Cập nhật tồn kho 201/201 – {status}*\n\n"
+                f"*Mã SP:* {it['code']}\n"
+                f"*Tên SP:* {it['name']}\n"
+                f"*Biến động:* {'+' if diff > 0 else ''}{diff} SP\n"
+                f"*Tổng tồn mới:* {it['new_qty']} SP\n\n"
+                f"*Mã lệnh:* {it['picking_name']}\n"
+                f"*Người thao tác:* {it['actor']}\n"
+                f"*Thời gian:* {now_vn}"
+            )
+
+    for chat_id in chat_ids:
+        for msg in messages:
+            NOTIFIER.submit(chat_id, msg, parse_mode="Markdown")
+
 
 # ---------------- WATCHDOG 201/201 ----------------
 WATCH_INTERVAL = 60
+WATCH_LOCATION = os.environ.get('WATCH_LOCATION', 'HN_STOCK')            # key trong STOCK_LOCATIONS
+WATCH_MODE = os.environ.get('WATCH_MODE', 'delta').lower()            # 'delta' | 'full'
+WATCH_FULL_RESYNC = int(os.environ.get('WATCH_FULL_RESYNC', '3600'))  # giây giữa 2 lần đọc toàn bộ
+
+WATCH_RESTORE_MAX_AGE = int(os.environ.get('WATCH_RESTORE_MAX_AGE', '86400'))  # baseline cũ hơn thì bỏ
+
 previous_snapshot = {}
+watch_cursors = {}
+last_full_sync = 0.0
+watch_location_id = None
+watchdog_last_success = 0.0
 
 
-def watchdog_201():
-    global previous_snapshot
-    tz = pytz.timezone("Asia/Ho_Chi_Minh")
+def _max_write_date(records, default=None):
+    dates = [r['write_date'] for r in records if r.get('write_date')]
+    return max(dates) if dates else default
 
-    while True:
-        try:
-            uid, models, err = connect_odoo()
-            if not uid:
-                logger.error(f"Watchdog không kết nối được Odoo: {err}")
-                time.sleep(WATCH_INTERVAL)
-                continue
 
-            location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
-            hn_id = location_ids.get("HN_STOCK", {}).get("id")
+def _snapshot_from_quants(quant_data, snapshot=None):
+    # Cộng dồn theo SP (một SP có thể có nhiều quant: lô, kiện...)
+    snapshot = {} if snapshot is None else snapshot
+    for q in quant_data:
+        if not q.get("product_id"):
+            continue
+        pid = q["product_id"][0]
+        snapshot[pid] = snapshot.get(pid, 0) + int(q.get("available_quantity") or 0)
+    return snapshot
+
+
+def _read_201_full(models, uid, hn_id):
+    snapshot = {}
+    quant_cursor = None
+    for quant_data in iter_search_read(
+        models, uid, "stock.quant", [("location_id", "=", hn_id)],
+        ["product_id", "available_quantity", "write_date"]
+    ):
+        _snapshot_from_quants(quant_data, snapshot)
+        batch_max = _max_write_date(quant_data)
+        if batch_max and (quant_cursor is None or batch_max > quant_cursor):
+            quant_cursor = batch_max
+
+    last_line = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.move.line", "search_read",
+        [["|", ("location_id", "=", hn_id), ("location_dest_id", "=", hn_id)]],
+        {"fields": ["write_date"], "limit": 1, "order": "write_date desc"}
+    )
 
-            if not hn_id:
-                logger.error("Watchdog: Không tìm thấy kho 201/201")
-                time.sleep(WATCH_INTERVAL)
-                continue
+    cursors = {
+        "quant": quant_cursor,
+        "move_line": _max_write_date(last_line),
+    }
+    return snapshot, cursors
+
+
+def _read_201_delta(models, uid, hn_id, snapshot, cursors):
+    # Chỉ hỏi các quant / move line đổi từ con trỏ write_date trước, rồi đọc lại
+    # tồn của đúng các SP đó (SP hết hàng có thể bị xóa quant nên phải đọc lại).
+    # Hỏi từ con trỏ lùi ODOO_CURSOR_OVERLAP giây (write_date là giờ bắt đầu transaction,
+    # lại chỉ chính xác tới giây); đọc trùng không ảnh hưởng kết quả.
+    quant_domain = [("location_id", "=", hn_id)]
+    if cursors.get("quant"):
+        quant_domain.append(("write_date", ">=", write_date_since(cursors["quant"])))
+    changed_quants = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.quant", "search_read",
+        [quant_domain],
+        {"fields": ["product_id", "write_date"]}
+    )
 
-            quant_data = models.execute_kw(
-                ODOO_DB, uid, ODOO_PASSWORD,
-                "stock.quant", "search_read",
-                [[("location_id", "=", hn_id)]],
-                {"fields": ["product_id", "available_quantity"]}
-            )
+    line_domain = ["|", ("location_id", "=", hn_id), ("location_dest_id", "=", hn_id)]
+    if cursors.get("move_line"):
+        line_domain.append(("write_date", ">=", write_date_since(cursors["move_line"])))
+    changed_lines = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.move.line", "search_read",
+        [line_domain],
+        {"fields": ["product_id", "write_date"]}
+    )
 
-            current_snapshot = {}
-            for q in quant_data:
-                pid = q["product_id"][0]
-                qty = int(q.get("available_quantity") or 0)
-                current_snapshot[pid] = qty
+    pids = sorted({
+        r["product_id"][0]
+        for r in changed_quants + changed_lines if r.get("product_id")
+    })
+
+    current = dict(snapshot)
+    if pids:
+        for pid in pids:
+            current.pop(pid, None)
+        for quant_data in iter_search_read(
+            models, uid, "stock.quant",
+            [("location_id", "=", hn_id), ("product_id", "in", pids)],
+            ["product_id", "available_quantity"]
+        ):
+            _snapshot_from_quants(quant_data, current)
+
+    new_cursors = {
+        "quant": _max_write_date(changed_quants, cursors.get("quant")),
+        "move_line": _max_write_date(changed_lines, cursors.get("move_line")),
+    }
+    return current, new_cursors
 
-            if not previous_snapshot:
-                previous_snapshot = current_snapshot
-                time.sleep(WATCH_INTERVAL)
-                continue
 
-            for pid, new_qty in current_snapshot.items():
-                old_qty = previous_snapshot.get(pid, 0)
-                if new_qty == old_qty:
-                    continue
+def poll_201_snapshot(models, uid, hn_id):
+    # Không tự dời con trỏ: watchdog_cycle chỉ ghi con trỏ cùng lúc với baseline,
+    # sau khi đã báo xong. Trả về (snapshot, con trỏ mới, thời điểm full sync hoặc None)
+    full = (
+        WATCH_MODE != "delta"
+        or not previous_snapshot
+        or not watch_cursors
+        or time.time() - last_full_sync >= WATCH_FULL_RESYNC
+    )
+    if full:
+        snapshot, cursors = _read_201_full(models, uid, hn_id)
+        synced_at = time.time()
+    else:
+        snapshot, cursors = _read_201_delta(models, uid, hn_id, previous_snapshot, watch_cursors)
+        synced_at = None
 
-                diff = new_qty - old_qty
+    return {pid: qty for pid, qty in snapshot.items() if qty}, cursors, synced_at
 
-                product_info = models.execute_kw(
-                    ODOO_DB, uid, ODOO_PASSWORD,
-                    "product.product", "read",
-                    [[pid]],
-                    {"fields": ["display_name", PRODUCT_CODE_FIELD]}
-                )[0]
 
-                code = product_info.get(PRODUCT_CODE_FIELD, "???")
-                name = product_info.get("display_name", "Không tên")
+def _picking_actor(picking_info):
+    w_uid = picking_info.get("write_uid")
+    c_uid = picking_info.get("create_uid")
 
-                move_data = models.execute_kw(
-                    ODOO_DB, uid, ODOO_PASSWORD,
-                    "stock.move", "search_read",
-                    [[("product_id", "=", pid)]],
-                    {"fields": ["id", "picking_id"], "limit": 1, "order": "id desc"}
-                )
+    actor = "Không xác định"
+    if w_uid:
+        actor = w_uid[1]
+    elif c_uid:
+        actor = c_uid[1]
 
-                picking_name = "N/A"
-                actor = "Không xác định"
-
-                if move_data:
-                    picking_info = None
-                    picking_field = move_data[0].get("picking_id")
-
-                    if picking_field:
-                        picking_id = picking_field[0]
-                        picking_info = models.execute_kw(
-                            ODOO_DB, uid, ODOO_PASSWORD,
-                            "stock.picking", "read",
-                            [[picking_id]],
-                            {"fields": ["name", "write_uid", "create_uid"]}
-                        )[0]
-
-                        picking_name = picking_info.get("name", "N/A")
-
-                        w_uid = picking_info.get("write_uid")
-                        c_uid = picking_info.get("create_uid")
-
-                        if w_uid:
-                            actor = w_uid[1]
-                        elif c_uid:
-                            actor = c_uid[1]
-
-                status = "NHẬP KHO" if diff > 0 else "XUẤT KHO"
-                now_vn = datetime.now(tz).strftime('%H:%M %d/%m/%Y')
-
-                msg = (
-                    f"📦 *Cập nhật tồn kho 201/201 – {status}*\n\n"
-                    f"*Mã SP:* {code}\n"
-                    f"*Tên SP:* {name}\n"
-                    f"*Biến động:* {'+' if diff > 0 else ''}{diff} SP\n"
-                    f"*Tổng tồn mới:* {new_qty} SP\n\n"
-                    f"*Mã lệnh:* {picking_name}\n"
-                    f"*Người thao tác:* {actor}\n"
-                    f"*Thời gian:* {now_vn}"
-                )
+    return {"picking_name": picking_info.get("name", "N/A"), "actor": actor}
 
-                for chat_id in get_registered_chat_ids():
-                    try:
-                        bot = Bot(token=TELEGRAM_TOKEN)
-                        asyncio.run(bot.send_message(chat_id, msg, parse_mode="Markdown"))
-                    except Exception as e:
-                        logger.error(f"Lỗi gửi thông báo tới {chat_id}: {e}")
 
-            previous_snapshot = current_snapshot
-            time.sleep(WATCH_INTERVAL)
+def _enrich_single_change(models, uid, pid):
+    # Đường dự phòng: 3 RPC cho 1 SP như trước
+    product_info = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "product.product", "read",
+        [[pid]],
+        {"fields": ["display_name", PRODUCT_CODE_FIELD]}
+    )[0]
+
+    info = {
+        "code": product_info.get(PRODUCT_CODE_FIELD, "???"),
+        "name": product_info.get("display_name", "Không tên"),
+        "picking_name": "N/A",
+        "actor": "Không xác định",
+    }
+
+    move_data = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.move", "search_read",
+        [[("product_id", "=", pid)]],
+        {"fields": ["id", "picking_id"], "limit": 1, "order": "id desc"}
+    )
+
+    if move_data and move_data[0].get("picking_id"):
+        picking_info = models.execute_kw(
+            ODOO_DB, uid, ODOO_PASSWORD,
+            "stock.picking", "read",
+            [[move_data[0]["picking_id"][0]]],
+            {"fields": ["name", "write_uid", "create_uid"]}
+        )[0]
+        info.update(_picking_actor(picking_info))
+
+    return info
+
+
+def enrich_watch_changes(models, uid, pids):
+    # Tên/mã SP, lệnh kho gần nhất và người thao tác cho cả lô SP thay đổi:
+    # luôn 4 RPC / chu kỳ thay vì 3 RPC / SP
+    pids = list(pids)
+    if not pids:
+        return {}
+
+    products = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "product.product", "read",
+        [pids],
+        {"fields": ["display_name", PRODUCT_CODE_FIELD]}
+    )
+    info = {
+        p["id"]: {
+            "code": p.get(PRODUCT_CODE_FIELD, "???"),
+            "name": p.get("display_name", "Không tên"),
+            "picking_name": "N/A",
+            "actor": "Không xác định",
+        }
+        for p in products
+    }
+
+    try:
+        groups = models.execute_kw(
+            ODOO_DB, uid, ODOO_PASSWORD,
+            "stock.move", "read_group",
+            [[("product_id", "in", pids)], ["id:max"], ["product_id"]],
+            {"lazy": False}
+        )
+    except xmlrpc.client.Fault as e:
+        logger.warning(f"Watchdog: read_group stock.move lỗi, tra từng SP: {e}")
+        return {pid: _enrich_single_change(models, uid, pid) for pid in pids}
+
+    latest_move = {
+        g["product_id"][0]: g["id"]
+        for g in groups if g.get("product_id") and g.get("id")
+    }
+    moves = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.move", "read",
+        [list(latest_move.values())],
+        {"fields": ["picking_id"]}
+    ) if latest_move else []
+    move_picking = {m["id"]: m["picking_id"][0] for m in moves if m.get("picking_id")}
+
+    picking_ids = sorted(set(move_picking.values()))
+    pickings = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD,
+        "stock.picking", "read",
+        [picking_ids],
+        {"fields": ["name", "write_uid", "create_uid"]}
+    ) if picking_ids else []
+    picking_map = {p["id"]: p for p in pickings}
+
+    for pid, move_id in latest_move.items():
+        picking = picking_map.get(move_picking.get(move_id))
+        if picking and pid in info:
+            info[pid].update(_picking_actor(picking))
 
+    return info
+
+
+def watchdog_cycle(tz):
+    # Một vòng kiểm tra 201/201; trả về số SP thay đổi
+    global previous_snapshot, watch_cursors, watch_location_id
+
+    uid, models, err = connect_odoo()
+    if not uid:
+        logger.error(f"Watchdog không kết nối được Odoo: {err}")
+        return 0
+
+    location_ids = find_required_location_ids(models, uid, ODOO_DB, ODOO_PASSWORD)
+    hn_id = location_ids.get(WATCH_LOCATION, {}).get("id")
+
+    if not hn_id:
+        logger.error(f"Watchdog: Không tìm thấy kho {REQUIRED_LOCATIONS.get(WATCH_LOCATION, WATCH_LOCATION)}")
+        return 0
+
+    if watch_location_id not in (None, hn_id):
+        # Baseline khôi phục thuộc kho khác (đổi cấu hình) -> đọc lại từ đầu
+        previous_snapshot = {}
+        watch_cursors = {}
+    watch_location_id = hn_id
+
+    current_snapshot, cursors, synced_at = poll_201_snapshot(models, uid, hn_id)
+
+    if not previous_snapshot:
+        _commit_watch_state(current_snapshot, cursors, synced_at)
+        return 0
+
+    changes = [
+        (pid, previous_snapshot.get(pid, 0), current_snapshot.get(pid, 0))
+        for pid in sorted(set(previous_snapshot) | set(current_snapshot))
+        if current_snapshot.get(pid, 0) != previous_snapshot.get(pid, 0)
+    ]
+    details = enrich_watch_changes(models, uid, [pid for pid, _, _ in changes])
+
+    now_vn = datetime.now(tz).strftime('%H:%M %d/%m/%Y')
+    items = []
+    for pid, old_qty, new_qty in changes:
+        detail = details.get(pid)
+        if not detail:
+            continue
+        items.append(dict(detail, diff=new_qty - old_qty, new_qty=new_qty))
+
+    notify_watch_changes(items, now_vn)
+    if changes:
+        INVENTORY.request_refresh()
+
+    _commit_watch_state(current_snapshot, cursors, synced_at)
+    return len(changes)
+
+
+def _commit_watch_state(snapshot, cursors, synced_at):
+    # Baseline và con trỏ luôn ghi cùng nhau, ở cuối vòng: nếu vòng lỗi giữa chừng
+    # thì vòng sau đọc delta lại từ con trỏ cũ nên không sót SP nào
+    global previous_snapshot, watch_cursors, last_full_sync
+    previous_snapshot = snapshot
+    watch_cursors = cursors
+    if synced_at is not None:
+        last_full_sync = synced_at
+    _save_watch_state()
+
+
+def _save_watch_state():
+    STATE.put(state_key('watchdog'), {
+        'location_id': watch_location_id,
+        'snapshot': list(previous_snapshot.items()),
+        'cursors': watch_cursors,
+        'last_full_sync': last_full_sync,
+        'saved_at': time.time(),
+    })
+
+
+def restore_watch_state(data):
+    # Baseline + con trỏ delta đã lưu: vòng đầu sau khi khởi động lại so sánh được ngay
+    # (báo cả thay đổi xảy ra lúc bot tắt) thay vì chỉ lấy baseline mới
+    global previous_snapshot, watch_cursors, last_full_sync, watch_location_id
+    if not data or time.time() - data.get('saved_at', 0) > WATCH_RESTORE_MAX_AGE:
+        return 0
+    previous_snapshot = {pid: qty for pid, qty in data['snapshot']}
+    watch_cursors = data['cursors'] or {}
+    last_full_sync = data['last_full_sync']
+    watch_location_id = data['location_id']
+    return len(previous_snapshot)
+
+
+def watchdog_201():
+    global watchdog_last_success
+    CURRENT_COMMAND.set('watchdog')
+    tz = pytz.timezone("Asia/Ho_Chi_Minh")
+
+    while True:
+        started = time.perf_counter()
+        try:
+            changed = watchdog_cycle(tz)
+            watchdog_last_success = time.time()
+            METRICS.inc('watchdog_changes_total', changed)
         except Exception as e:
             logger.error(f"Lỗi watchdog: {e}")
-            time.sleep(WATCH_INTERVAL)
+        METRICS.observe('watchdog_cycle_duration_seconds', time.perf_counter() - started)
+        time.sleep(WATCH_INTERVAL)
+
+
+def _runtime_metrics():
+    out = []
+    if watchdog_last_success:
+        out.append(('watchdog_lag_seconds', {}, round(time.time() - watchdog_last_success, 3)))
+    for pool in (WORK_POOL, PO_JOBS.pool):
+        stats = pool.stats()
+        out.append(('worker_queue', {'pool': pool.name, 'state': 'queued'}, stats['queued']))
+        out.append(('worker_queue', {'pool': pool.name, 'state': 'running'}, stats['running']))
+    out.append(('singleflight_inflight', {}, SINGLE_FLIGHT.inflight()))
+    cache = REPORT_CACHE.stats()
+    out.append(('report_cache_size', {'unit': 'entries'}, cache['entries']))
+    out.append(('report_cache_size', {'unit': 'bytes'}, cache['bytes']))
+    out.append(('notify_messages', {'state': 'sent'}, NOTIFIER.sent))
+    out.append(('notify_messages', {'state': 'failed'}, NOTIFIER.failed))
+    out.append(('notify_messages', {'state': 'dropped'}, NOTIFIER.dropped))
+    snap = INVENTORY.peek()
+    if snap is not None:
+        out.append(('inventory_snapshot_age_seconds', {}, round(time.time() - snap.refreshed_at, 3)))
+    for name, alive in SERVICES.status().items():
+        out.append(('bot_service_up', {'service': name}, int(alive)))
+    for module, seconds in LAZY_IMPORT_SECONDS.items():
+        out.append(('bot_lazy_import_seconds', {'module': module}, seconds))
+    return out
+
+
+METRICS.add_callback(_runtime_metrics)
 
 
-threading.Thread(target=watchdog_201, daemon=True).start()
+def warm_start():
+    # Nạp lại trạng thái đã lưu trước khi các luồng nền chạy; trả về số giây đã dùng
+    started = time.perf_counter()
+    restored = {}
+    if STATE.enabled:
+        for name, restore in (
+            ('chat', restore_chat_ids),
+            ('kho', lambda: LOCATION_REGISTRY.restore(STATE.get(state_key('locations')))),
+            ('SP danh mục', lambda: PRODUCT_CATALOG.restore(STATE.get(state_key('catalog')))),
+            ('SP baseline watchdog', lambda: restore_watch_state(STATE.get(state_key('watchdog')))),
+        ):
+            try:
+                restored[name] = restore()
+            except Exception as e:
+                logger.warning(f"Lỗi khôi phục {name}: {e}")
+
+    elapsed = time.perf_counter() - started
+    METRICS.set('bot_startup_seconds', round(elapsed, 4), phase='restore')
+    summary = ", ".join(f"{n} {name}" for name, n in restored.items())
+    logger.info(f"Khôi phục trạng thái ({STATE_DB or 'tắt'}) trong {elapsed:.3f}s: {summary}")
+    return elapsed
+
+
+SERVICES.register('watchdog', watchdog_201)
 
 
 # ---------------- MAIN ----------------
+async def _start_notifier(application):
+    NOTIFIER.start(application.bot)
+    ready = time.perf_counter() - BOT_STARTED_AT
+    METRICS.set('bot_startup_seconds', round(ready, 4), phase='ready')
+    logger.info(f"Sẵn sàng nhận tin sau {ready:.2f}s")
+
+
+async def _stop_notifier(application):
+    await NOTIFIER.stop()
+
+
 def main():
     if not TELEGRAM_TOKEN or not ODOO_URL_RAW or not ODOO_DB or not ODOO_USERNAME or not ODOO_PASSWORD:
         logger.error("Thiếu cấu hình môi trường (token, url, db, user, pass).")
         return
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Trạng thái đã lưu phải nạp xong trước khi watchdog chạy vòng đầu
+    warm_start()
+    atexit.register(STATE.close)
+    SERVICES.start()
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(_start_notifier)
+        .post_shutdown(_stop_notifier)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .build()
+    )
 
     try:
         bot = Bot(token=TELEGRAM_TOKEN)
@@ -964,6 +3649,8 @@ def main():
     application.add_handler(CommandHandler("ping", ping_command))
     application.add_handler(CommandHandler("keohang", excel_report_command))
     application.add_handler(CommandHandler("checkpo", checkpo_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_po_file))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_product_code))
 